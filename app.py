@@ -1,39 +1,135 @@
-import os, re, json, uuid
-from typing import Any, Dict, List, Tuple
-from fastapi import FastAPI, UploadFile, File, Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+import os, re, json, uuid, math, time, random, hashlib, bisect, contextvars, functools, asyncio, itertools, threading, multiprocessing, posixpath, zipfile
+import codecs, gzip, hmac, logging, shutil, sys, zlib
+import importlib.util
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from html.parser import HTMLParser
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+_BOOT_T0 = time.perf_counter()  # отсчёт для отчёта о запуске: FastAPI и остальное ниже входят в import_s
+from fastapi import FastAPI, UploadFile, File, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
 import httpx
 
-# ---- опционально: PyMuPDF для PDF ----
-fitz = None
-try:
-    import fitz as _fitz  # PyMuPDF
-    fitz = _fitz
-except Exception:
-    pass
+# ---- отчёт о запуске и ленивые импорты ----
+# Тяжёлые необязательные зависимости (PyMuPDF) грузятся при первом использовании, а не при старте
+# воркера; что и когда загрузилось — в /stats → startup.
+BOOT_WATCH = ("fitz", "pymupdf", "httpx", "httpcore", "h2", "tiktoken", "langchain", "streamlit", "PyPDF2")
+_BOOT: Dict[str, Any] = {"import_s": None, "ready_s": None, "steps": {}, "modules": None, "loaded": {}, "lazy": {}}
+_LAZY: Dict[str, Any] = {}
+
+
+def _optional_import(name: str) -> Any:
+    """Модуль или None, если не установлен; импорт один раз, время попадает в _BOOT["lazy"]."""
+    if name not in _LAZY:
+        t0 = time.perf_counter()
+        try:
+            _LAZY[name] = importlib.import_module(name)
+        except Exception:
+            _LAZY[name] = None
+        _BOOT["lazy"][name] = {"ok": _LAZY[name] is not None, "seconds": round(time.perf_counter() - t0, 4),
+                               "at_s": round(time.perf_counter() - _BOOT_T0, 3)}
+    return _LAZY[name]
+
+
+@functools.lru_cache(maxsize=None)
+def _available(name: str) -> bool:
+    """Установлен ли модуль — без импорта (для проверок на пути запроса)."""
+    return importlib.util.find_spec(name) is not None
+
+
+def _fitz() -> Any:
+    return _optional_import("fitz")  # PyMuPDF
+
+
+@contextmanager
+def _boot_step(name: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _BOOT["steps"][name] = round(time.perf_counter() - t0, 4)
+
+
+def _boot_report() -> Dict[str, Any]:
+    _BOOT.update(ready_s=round(time.perf_counter() - _BOOT_T0, 3), modules=len(sys.modules),
+                 loaded={m: m in sys.modules for m in BOOT_WATCH})
+    heavy = ", ".join(m for m, on in _BOOT["loaded"].items() if on) or "—"
+    logging.getLogger("uvicorn.error").info(
+        "startup: import %.3fs, ready %.3fs, %d modules, loaded: %s", _BOOT["import_s"] or 0, _BOOT["ready_s"],
+        _BOOT["modules"], heavy)
+    return _BOOT
 
 # =========================
 #  Внешний API (игра/чат)
 # =========================
 APPROXINATION_TOKEN = os.getenv("APPROXINATION_TOKEN", "379f5469-cb64-47ec-bab1-462ee3824c1b")
-API_URL = "https://approxination.com/v1/chat/completions"
+API_URL = os.getenv("API_URL", "https://approxination.com/v1/chat/completions")  # bench/mock_upstream.py — локальная замена
 HEADERS = {"Content-Type": "application/json", "Authorization": f"Bearer {APPROXINATION_TOKEN}"}
 
+# пул соединений общего клиента (см. «Общий HTTP-клиент»)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2 = str(os.getenv("HTTP2", "")).strip().lower() in ("1", "true", "yes", "on")
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "32"))
+
+# таймауты и устойчивость (см. «Устойчивость вызовов к внешнему API»)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "300"))          # потолок ожидания ответа
+UPSTREAM_READ_TIMEOUT_MIN = float(os.getenv("UPSTREAM_READ_TIMEOUT_MIN", "30"))   # нижняя граница адаптивного
+UPSTREAM_STREAM_IDLE = float(os.getenv("UPSTREAM_STREAM_IDLE", "60"))             # тишина в потоке чата
+CHAT_STREAM_BUDGET = float(os.getenv("CHAT_STREAM_BUDGET", "180"))                # потолок на весь поток чата
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+UPSTREAM_CB_FAILURES = int(os.getenv("UPSTREAM_CB_FAILURES", "5"))                # подряд, чтобы разомкнуть
+UPSTREAM_CB_COOLDOWN = float(os.getenv("UPSTREAM_CB_COOLDOWN", "30"))
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOAD_ROOT = os.path.join(BASE_DIR, "uploads")
+UPLOAD_ROOT = os.getenv("UPLOAD_ROOT", os.path.join(BASE_DIR, "uploads"))
 SAMPLES_ROOT = os.path.join(BASE_DIR, "samples")
-os.makedirs(UPLOAD_ROOT, exist_ok=True)
-os.makedirs(SAMPLES_ROOT, exist_ok=True)
 
 ALLOWED_UPLOADS = {"pdf", "epub", "fb2", "txt"}
-CHUNK_LIMIT = 5  # быстрый разбор для загруженных файлов
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))     # кусок записи/чтения
+UPLOAD_FORM_SLACK = 64 * 1024  # запас на multipart-обёртку поверх самого файла
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    # вся работа при старте — здесь, а не при импорте модуля; время шагов — в /stats → startup
+    with _boot_step("storage"):
+        os.makedirs(UPLOAD_ROOT, exist_ok=True)
+        os.makedirs(SAMPLES_ROOT, exist_ok=True)
+    with _boot_step("samples"): _samples_items()
+    with _boot_step("prewarm"):
+        # клиент к внешнему API создаётся при первом вызове; его транспорт (httpcore, ~0.2 с импорта)
+        # подтягиваем в фоновом потоке, чтобы его не ждали ни старт, ни первый запрос
+        asyncio.get_running_loop().run_in_executor(None, _optional_import, "httpcore")
+    with _boot_step("generation_queue"): _gen_start()
+    with _boot_step("maintenance"): _maint_start()
+    with _boot_step("ingest_heartbeat"): _heartbeat_start()
+    _boot_report()
+    try:
+        yield
+    finally:
+        await _maint_stop()
+        await _heartbeat_stop()
+        await _gen_stop()
+        await _upstream_close()
 
-app = FastAPI(title="Reader + Game + GPT")
+
+app = FastAPI(title="Reader + Game + GPT", lifespan=_lifespan)
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)  # SSE (text/event-stream) не сжимается
 app.mount("/static", StaticFiles(directory=BASE_DIR), name="static")
 
 
@@ -46,9 +142,183 @@ def _allowed_file(name: str) -> bool:
     return "." in name and name.rsplit(".", 1)[1].lower() in ALLOWED_UPLOADS
 
 
-def _request_timeout():
-    flag = str(os.getenv("NO_TIMEOUT", "")).strip().lower()
-    return None if flag in ("1", "true", "yes", "on") else None
+def _timeouts_disabled() -> bool:
+    return str(os.getenv("NO_TIMEOUT", "")).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _request_timeout(read: Optional[float] = None) -> httpx.Timeout:
+    """Раздельные таймауты: соединение — коротко, чтение — read (по умолчанию UPSTREAM_READ_TIMEOUT).
+    NO_TIMEOUT=1 отключает их целиком."""
+    if _timeouts_disabled():
+        return httpx.Timeout(None)
+    c = UPSTREAM_CONNECT_TIMEOUT
+    return httpx.Timeout(UPSTREAM_READ_TIMEOUT if read is None else read, connect=c, write=c, pool=c)
+
+
+# =========================
+#  Метрики (Prometheus / OpenMetrics)
+# =========================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KB … 256 MB
+
+_METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "Время обработки запроса (для потоков — до конца ответа)"),
+    "http_response_bytes_total": ("counter", "Байт отдано клиентам"),
+    "stage_duration_seconds": ("histogram", "Время этапов обработки: разбор, пагинация, запись JSON, индекс, контекст, внешний API"),
+    "upstream_request_duration_seconds": ("histogram", "Время ответа внешнего API (до заголовков у потоков)"),
+    "upstream_responses_total": ("counter", "Ответы внешнего API по HTTP-статусу"),
+    "upstream_errors_total": ("counter", "Сбои вызова внешнего API по типу исключения"),
+    "upstream_sent_bytes_total": ("counter", "Байт отправлено во внешний API"),
+    "upstream_received_bytes_total": ("counter", "Байт получено от внешнего API"),
+    "document_bytes": ("histogram", "Размер загруженных файлов"),
+    "document_chars": ("histogram", "Объём текста разобранных документов, символов"),
+    "cache_hits_total": ("counter", "Попадания в кэш"),
+    "cache_misses_total": ("counter", "Промахи кэша"),
+    "cache_entries": ("gauge", "Записей в кэше"),
+    "cache_bytes": ("gauge", "Объём кэша в байтах"),
+    "upstream_circuit_open": ("gauge", "1 — предохранитель внешнего API разомкнут"),
+    "upstream_retries_total": ("counter", "Повторные попытки вызова внешнего API"),
+    "generate_jobs": ("gauge", "Задачи генерации в работе и в очереди"),
+}
+
+# trace_id текущего запроса: middleware кладёт сюда пустой dict, обработчик — свой trace_id
+_TRACE: "contextvars.ContextVar[Optional[Dict[str, str]]]" = contextvars.ContextVar("trace", default=None)
+
+
+def _new_trace_id() -> str:
+    trace_id = str(uuid.uuid4())[:8]
+    holder = _TRACE.get()
+    if holder is not None: holder["trace_id"] = trace_id
+    return trace_id
+
+
+def _current_trace_id() -> Optional[str]:
+    holder = _TRACE.get()
+    return holder.get("trace_id") if holder else None
+
+
+class _Metrics:
+    """Счётчики и гистограммы в памяти процесса, без внешних зависимостей. Потокобезопасно —
+    этапы разбора пишут из пула потоков. У гистограмм на каждую корзину хранится последний
+    exemplar с trace_id (виден в формате OpenMetrics)."""
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._hists: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                exemplar: Optional[Dict[str, str]] = None, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = {"buckets": buckets, "counts": [0] * (len(buckets) + 1),
+                                        "exemplars": [None] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            i = next((i for i, le in enumerate(h["buckets"]) if value <= le), len(h["buckets"]))
+            h["counts"][i] += 1
+            h["sum"] += value; h["count"] += 1
+            if exemplar: h["exemplars"][i] = (exemplar, value, time.time())
+
+    @contextmanager
+    def stage(self, stage: str, trace_id: Optional[str] = None, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            tid = trace_id or _current_trace_id()
+            self.observe("stage_duration_seconds", time.perf_counter() - started,
+                         exemplar={"trace_id": tid} if tid else None, stage=stage, **labels)
+
+    @staticmethod
+    def _fmt_labels(labels: Iterable[Tuple[str, str]]) -> str:
+        items = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+        return "{" + items + "}" if items else ""
+
+    def render(self, gauges: Iterable[Tuple[str, Dict[str, Any], float]] = (), openmetrics: bool = False) -> str:
+        """Текстовый формат Prometheus; openmetrics=True — с exemplars и # EOF."""
+        series: Dict[str, List[str]] = {}
+        with self._lock:
+            counters = list(self._counters.items())
+            hists = [(k, {**h, "counts": list(h["counts"]), "exemplars": list(h["exemplars"])}) for k, h in self._hists.items()]
+        for (name, labels), value in counters:
+            series.setdefault(name, []).append(f"{name}{self._fmt_labels(labels)} {value:g}")
+        for name, labels, value in gauges:
+            series.setdefault(name, []).append(f"{name}{self._fmt_labels(sorted((k, str(v)) for k, v in labels.items()))} {value:g}")
+        for (name, labels), h in hists:
+            lines = series.setdefault(name, [])
+            acc = 0
+            for i, le in enumerate(list(h["buckets"]) + [float("inf")]):
+                acc += h["counts"][i]
+                le_s = "+Inf" if le == float("inf") else f"{le:g}"
+                line = f"{name}_bucket{self._fmt_labels(list(labels) + [('le', le_s)])} {acc}"
+                ex = h["exemplars"][i]
+                if openmetrics and ex:
+                    line += f" # {self._fmt_labels(ex[0].items())} {ex[1]:g} {ex[2]:.3f}"
+                lines.append(line)
+            lines.append(f"{name}_sum{self._fmt_labels(labels)} {h['sum']:g}")
+            lines.append(f"{name}_count{self._fmt_labels(labels)} {h['count']}")
+        out = []
+        for name in sorted(series):
+            kind, help_text = _METRIC_HELP.get(name, ("untyped", ""))
+            # в OpenMetrics семейство счётчика называется без _total, сами значения — с ним
+            family = name[:-6] if openmetrics and kind == "counter" and name.endswith("_total") else name
+            out.append(f"# HELP {family} {help_text}")
+            out.append(f"# TYPE {family} {'unknown' if openmetrics and kind == 'untyped' else kind}")
+            out.extend(series[name])
+        if openmetrics: out.append("# EOF")
+        return "\n".join(out) + "\n"
+
+
+METRICS = _Metrics()
+
+
+class _MetricsMiddleware:
+    """ASGI-middleware (не BaseHTTPMiddleware — чтобы не буферизовать SSE): время запроса по шаблону
+    маршрута, байты ответа и заголовок X-Trace-Id с trace_id, который выдал обработчик."""
+
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        holder: Dict[str, str] = {}
+        token = _TRACE.set(holder)
+        started = time.perf_counter()
+        state = {"status": 500, "bytes": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                if holder.get("trace_id"):
+                    message = {**message, "headers": list(message.get("headers", [])) + [(b"x-trace-id", holder["trace_id"].encode())]}
+            elif message["type"] == "http.response.body":
+                state["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _TRACE.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            tid = holder.get("trace_id")
+            METRICS.observe("http_request_duration_seconds", time.perf_counter() - started,
+                            exemplar={"trace_id": tid} if tid else None,
+                            route=route, method=scope["method"], status=state["status"])
+            METRICS.inc("http_response_bytes_total", state["bytes"], route=route)
+
+
+app.add_middleware(_MetricsMiddleware)
 
 
 # =========================
@@ -127,31 +397,650 @@ ____________________________________________________________
 # =========================
 #  Разбор текста
 # =========================
-def _pdf_to_text_chunks(pdf_path: str, max_chars: int = 16000) -> List[str]:
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0"))  # процессов на извлечение; 0 — по числу ядер, 1 — без пула
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+_PDF_POOL: Optional[ProcessPoolExecutor] = None
+_PDF_POOL_LOCK = threading.Lock()
+
+
+def _pdf_workers() -> int:
+    return max(1, PDF_WORKERS or os.cpu_count() or 1)
+
+
+def _pdf_pool() -> ProcessPoolExecutor:
+    global _PDF_POOL
+    with _PDF_POOL_LOCK:
+        if _PDF_POOL is None:
+            # spawn: форк процесса с живыми потоками event loop/пула небезопасен
+            _PDF_POOL = ProcessPoolExecutor(max_workers=_pdf_workers(), mp_context=multiprocessing.get_context("spawn"))
+        return _PDF_POOL
+
+
+def _pdf_extract_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """Выполняется в дочернем процессе: каждый воркер открывает документ сам."""
+    with _fitz().open(pdf_path) as doc:
+        return [doc[i].get_text("text") for i in range(start, end)]
+
+
+def _iter_pdf_pages(pdf_path: str, progress: Optional[Callable[[int, int], None]] = None,
+                    workers: Optional[int] = None) -> Iterator[str]:
+    """Тексты страниц по одной — документ целиком в память не собирается.
+    Большие PDF режутся на диапазоны страниц и разбираются в пуле процессов; порядок страниц сохраняется."""
+    fitz = _fitz()
     if not fitz:
         raise RuntimeError("PyMuPDF не установлен (pip install pymupdf)")
-    doc = fitz.open(pdf_path)
-    buf, chunks, size = [], [], 0
-    for page in doc:
-        t = page.get_text("text")
+    workers = workers or _pdf_workers()
+    with fitz.open(pdf_path) as doc:
+        total = doc.page_count
+        if workers <= 1 or total < PDF_PARALLEL_MIN_PAGES:
+            for i, page in enumerate(doc, 1):
+                yield page.get_text("text")
+                if progress: progress(i, total)
+            return
+
+    batch = max(8, math.ceil(total / (workers * 4)))
+    ranges = [(a, min(total, a + batch)) for a in range(0, total, batch)]
+    pool, pending, done = _pdf_pool(), deque(), 0
+    todo = iter(ranges)
+    # держим в работе не больше 2×workers диапазонов, чтобы готовые страницы не копились в памяти
+    for a, b in itertools.islice(todo, workers * 2):
+        pending.append(pool.submit(_pdf_extract_range, pdf_path, a, b))
+    while pending:
+        texts = pending.popleft().result()
+        nxt = next(todo, None)
+        if nxt: pending.append(pool.submit(_pdf_extract_range, pdf_path, *nxt))
+        for t in texts:
+            done += 1
+            yield t
+            if progress: progress(done, total)
+
+
+def _iter_text_chunks(pages: Iterable[str], max_chars: int = 16000) -> Iterator[str]:
+    buf, size = [], 0
+    for t in pages:
         if size + len(t) > max_chars and size > 0:
-            chunks.append("".join(buf)); buf, size = [t], len(t)
+            yield "".join(buf); buf, size = [t], len(t)
         else:
             buf.append(t); size += len(t)
-    if buf: chunks.append("".join(buf))
-    return chunks
+    if buf: yield "".join(buf)
 
 
-def _simple_pages(text: str, page_chars: int = 1200) -> List[str]:
-    paras = [p.strip() for p in re.split(r"\n{2,}", text) if p.strip()]
-    pages, buf, size = [], [], 0
-    for p in paras:
-        if size + len(p) > page_chars and size > 0:
-            pages.append("\n\n".join(buf)); buf, size = [p], len(p)
-        else:
-            buf.append(p); size += len(p)
-    if buf: pages.append("\n\n".join(buf))
-    return pages
+def _pdf_to_text_chunks(pdf_path: str, max_chars: int = 16000) -> List[str]:
+    return list(_iter_text_chunks(_iter_pdf_pages(pdf_path), max_chars))
+
+
+class _HtmlText(HTMLParser):
+    """XHTML главы EPUB -> абзацы; первый заголовок h1–h3 становится названием главы."""
+    _BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+               "blockquote", "pre", "section", "article", "dd", "dt"}
+    _SKIP = {"script", "style", "head"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paras: List[str] = []
+        self.title = ""
+        self._buf: List[str] = []
+        self._skip = 0
+        self._heading = False
+
+    def _flush(self) -> str:
+        text = " ".join("".join(self._buf).split())
+        self._buf = []
+        if text: self.paras.append(text)
+        return text
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP: self._skip += 1
+        elif tag in self._BLOCKS: self._flush()
+        if tag in ("h1", "h2", "h3") and not self.title: self._heading = True
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP: self._skip = max(0, self._skip - 1)
+        elif tag in self._BLOCKS:
+            text = self._flush()
+            if self._heading and text:
+                self.title, self._heading = text, False
+
+    def handle_data(self, data):
+        if not self._skip: self._buf.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def _iter_epub_chapters(path: str, progress: Optional[Callable[[int, int], None]] = None) -> Iterator[Dict[str, Any]]:
+    """EPUB = zip: container.xml -> OPF -> spine. Документы spine читаются по одному."""
+    with zipfile.ZipFile(path) as z:
+        container = ET.fromstring(z.read("META-INF/container.xml"))
+        rootfile = container.find(".//{*}rootfile")
+        if rootfile is None or not rootfile.get("full-path"):
+            raise RuntimeError("EPUB: не найден OPF (META-INF/container.xml)")
+        opf_path = rootfile.get("full-path")
+        opf = ET.fromstring(z.read(opf_path))
+        base = posixpath.dirname(opf_path)
+        manifest = {it.get("id"): (it.get("href") or "", it.get("media-type") or "") for it in opf.findall(".//{*}manifest/{*}item")}
+        spine = [ref.get("idref") for ref in opf.findall(".//{*}spine/{*}itemref")]
+        names = set(z.namelist())
+        n = 0
+        for i, idref in enumerate(spine, 1):
+            href, media = manifest.get(idref, ("", ""))
+            item = posixpath.normpath(posixpath.join(base, unquote(href.split("#", 1)[0])))
+            if item in names and "html" in media:
+                parser = _HtmlText()
+                parser.feed(z.read(item).decode("utf-8", errors="ignore"))
+                parser.close()
+                if parser.paras:
+                    n += 1
+                    yield {"title": parser.title or f"Глава {n}", "text": "\n\n".join(parser.paras), "sections": []}
+            if progress: progress(i, len(spine))
+
+
+def _xml_local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def _iter_fb2_chapters(path: str) -> Iterator[Dict[str, Any]]:
+    """FB2 через iterparse: каждая <section> открывает новую главу, разобранные узлы сразу очищаются,
+    так что память не растёт с размером файла. Заголовки вложенных секций склеиваются («Часть 1 — Глава 2»)."""
+    titles: List[str] = []  # заголовки открытых секций
+    paras: List[str] = []
+    in_main, in_title, n = False, 0, 0
+
+    def chapter() -> Dict[str, Any]:
+        title = " — ".join(t for t in titles if t) or f"Глава {n}"
+        return {"title": title, "text": "\n\n".join(paras), "sections": []}
+
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        tag = _xml_local(elem.tag)
+        if event == "start":
+            if tag == "body":
+                in_main = elem.get("name") not in ("notes", "comments")
+            elif tag == "section" and in_main:
+                if paras:
+                    n += 1; yield chapter(); paras = []
+                titles.append("")
+            elif tag == "title":
+                in_title += 1
+            continue
+
+        if tag == "title":
+            in_title -= 1
+            if in_main and titles and not in_title:
+                titles[-1] = " ".join(" ".join(elem.itertext()).split())
+            elem.clear()
+        elif tag in ("p", "v", "subtitle", "text-author") and not in_title:
+            if in_main:
+                text = " ".join("".join(elem.itertext()).split())
+                if text: paras.append(text)
+            elem.clear()
+        elif tag == "section" and in_main:
+            if paras:
+                n += 1; yield chapter(); paras = []
+            if titles: titles.pop()
+            elem.clear()
+        elif tag == "body":
+            if in_main and paras:
+                n += 1; yield chapter(); paras = []
+            in_main = False
+            elem.clear()
+        elif tag == "binary":
+            elem.clear()  # картинки в base64 — самые тяжёлые узлы
+
+
+TXT_PART_CHARS = int(os.getenv("TXT_PART_CHARS", "16000"))
+# римские цифры — только прописные и только правильной записи: иначе «Did», «Mix», «I» — заголовки
+_TXT_ROMAN = r"(?=[IVXLCDM])M{0,3}(?:CM|CD|D?C{0,3})(?:XC|XL|L?X{0,3})(?:IX|IV|V?I{0,3})(?!\w)"
+# номер главы без ключевого слова — только до LXXXIX: «MIX», «MD», «DC», «CD» — аббревиатуры, не главы
+_TXT_SMALL_ROMAN = r"(?=[IVXL])(?:XL|L?X{0,3})(?:IX|IV|V?I{0,3})(?!\w)"
+_TXT_ORDINAL = (r"(?i:(?:перв|втор|трет|четв[её]рт|пят|шест|седьм|восьм|девят|десят)(?:ая|ый|ой|ое|ья|ий|ье)"
+                r"|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve"
+                r"|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth)(?!\w)")
+_TXT_KEYWORD = r"(?i:глава|часть|книга|chapter|part|book)\s+(?:\d+(?!\w)|" + _TXT_ROMAN + "|" + _TXT_ORDINAL + ")"
+_TXT_SECTION = r"(?i:пролог|эпилог|предисловие|послесловие|введение|заключение|prologue|epilogue)(?!\w)"
+# однозначный заголовок: «Глава 3», «Глава 3. Возвращение», «Part Two: …», «Пролог», «# …», «XII», «V.»
+_TXT_HEADING_RE = re.compile(
+    r"#{1,3}\s+\S.*"
+    rf"|(?:{_TXT_KEYWORD}|{_TXT_SECTION})(?:\s*[.:—–-]\s*\S.*|\.)?"
+    rf"|(?=\w\w|\w\.){_TXT_SMALL_ROMAN}\.?")
+# похоже на заголовок, но может быть и фразой («Chapter 1 The Boy», «Book Two Arrives Today») или
+# одной буквой («I», «V»): главу открываем, строку из текста не выбрасываем
+_TXT_HEADING_LOOSE_RE = re.compile(rf"(?:{_TXT_KEYWORD}|{_TXT_SECTION})\s+[A-ZА-ЯЁ«\"].*|[IVX]")
+_TXT_NUMBER_END_RE = re.compile(rf"(?:\d+|{_TXT_ROMAN}|{_TXT_ORDINAL})\.$")
+
+
+def _txt_heading(line: str) -> Tuple[str, bool]:
+    """Заголовок главы в TXT и однозначен ли он; ("", False) — обычный текст. Длинные строки и строки
+    со знаком препинания на конце — текст («Часть тела болела.»); точку прощаем только после номера
+    («Глава 3.»). Ключевому слову нужен номер: цифры, прописная римская или порядковое слово
+    («Part of the problem» — не заголовок)."""
+    s = line.strip()
+    if not s or len(s) > 80: return "", False
+    if s.endswith((",", ";", ":", "!", "?", "…")) or (s.endswith(".") and not _TXT_NUMBER_END_RE.search(s)): return "", False
+    if _TXT_HEADING_RE.fullmatch(s): return s.lstrip("#").strip(), True
+    if _TXT_HEADING_LOOSE_RE.fullmatch(s): return s, False
+    return "", False
+
+
+def _iter_txt_chapters(path: str) -> Iterator[Dict[str, Any]]:
+    """TXT построчно (в памяти — только текущая глава): строка-заголовок после пустой строки открывает главу,
+    заголовки подряд склеиваются («Часть 1 — Глава 2»); неоднозначный заголовок остаётся и в тексте. Текст без заголовков (и до первого из них)
+    режется на «Часть N» по границам абзацев примерно по TXT_PART_CHARS символов."""
+    title, lines, size, n, blank = "", [], 0, 0, True
+
+    def chapter() -> Dict[str, Any]:
+        return {"title": title or f"Часть {n}", "text": "".join(lines), "sections": []}
+
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+        for line in f:
+            heading, strict = _txt_heading(line) if blank else ("", False)
+            if heading:
+                if size:
+                    n += 1; yield chapter(); title, lines, size = "", [], 0
+                title = f"{title} — {heading}" if title else heading
+                if strict: continue  # иначе строка остаётся и в тексте главы
+            blank = not line.strip()
+            if blank and not title and size >= TXT_PART_CHARS:
+                n += 1; yield chapter(); lines, size = [], 0
+            elif not blank or size:
+                lines.append(line); size += len(line.strip())
+    if size:
+        n += 1; yield chapter()
+
+
+def _normalize_text(text: str) -> str:
+    """Абзацы без пробелов по краям, между ними ровно одна пустая строка."""
+    return "\n\n".join(p.strip() for p in re.split(r"\n{2,}", text or "") if p.strip())
+
+
+_PARA_SEP_RE = re.compile(r"\n{2,}")
+_NON_WS_RE = re.compile(r"\S")
+_SENTENCE_END_RE = re.compile(r"[.!?…]+[\"'»”)\]]*(?=\s)")
+_WORD_END_RE = re.compile(r"\S(?=\s)")
+
+
+def _iter_page_spans(blocks: Iterable[str], page_chars: int = 1200, page_bytes: int = 0) -> Iterator[Tuple[int, int, int, int]]:
+    """Потоковая пагинация: по кускам текста (любого размера, например чтение text.txt блоками) отдаёт
+    страницы (start, end, byte_start, byte_end) — смещения в символах и в байтах UTF-8, без копий текста.
+    Абзацы набираются на страницу, пока не превысят бюджет (page_chars символов или page_bytes байт);
+    абзац длиннее бюджета режется по концам предложений (иначе по пробелу). В памяти — только
+    текущая страница, незаконченный абзац (до двух бюджетов) и очередной блок."""
+    limit = max(1, page_bytes or page_chars)
+    buf, base = "", 0        # buf == text[base:]
+    scan = 0                 # отсюда текст ещё не разобран на абзацы
+    cur_c = cur_b = 0        # курсор «символ -> байт», двигается только вперёд
+    page_a = page_b = -1
+    size = 0
+
+    def measure(a: int, b: int) -> int:
+        return len(buf[a - base:b - base].encode("utf-8")) if page_bytes else b - a
+
+    def to_bytes(c: int) -> int:
+        nonlocal cur_c, cur_b
+        if c > cur_c:
+            cur_b += len(buf[cur_c - base:c - base].encode("utf-8")); cur_c = c
+        return cur_b
+
+    def cut(a: int, b: int) -> int:
+        # конец куска [a, …) в пределах бюджета: последний конец предложения, иначе пробел, иначе жёстко
+        w = min(b, a + limit)
+        while page_bytes and w > a + 1 and measure(a, w) > limit:
+            w = a + max(1, (w - a) * limit // measure(a, w))
+        floor = a + (w - a) // 4
+        last = None
+        for last in _SENTENCE_END_RE.finditer(buf, floor - base, w - base): pass
+        if last: return last.end() + base
+        sp = buf.rfind(" ", floor - base, w - base)
+        return sp + base if sp > floor - base else w
+
+    def pieces(a: int, b: int, done: bool) -> Tuple[List[Tuple[int, int]], int]:
+        # абзац [a, b) -> куски не больше бюджета; у незаконченного (done=False) хвост до 2*limit остаётся ждать
+        out = []
+        while (measure(a, b) > limit) if done else (b - a > 2 * limit):
+            c = cut(a, b)
+            out.append((a, c))
+            m = _NON_WS_RE.search(buf, c - base, b - base)
+            a = m.start() + base if m else b
+        if done and a < b: out.append((a, b))
+        return out, a
+
+    def add(a: int, b: int) -> Optional[Tuple[int, int, int, int]]:
+        nonlocal page_a, page_b, size
+        n, full = measure(a, b), None
+        if size + n > limit and size > 0:
+            full = (page_a, page_b, to_bytes(page_a), to_bytes(page_b))
+            page_a, size = a, 0
+        elif page_a < 0:
+            page_a = a
+        to_bytes(page_a)  # всё до начала текущей страницы из буфера уже не нужно
+        page_b = b; size += n
+        return full
+
+    def paragraph(p0: int, p1: int, done: bool) -> Iterator[Tuple[int, int, int, int]]:
+        nonlocal scan
+        m = _NON_WS_RE.search(buf, p0 - base, p1 - base)
+        if not m:
+            scan = p1; return
+        a = m.start() + base
+        b = a + len(buf[a - base:p1 - base].rstrip()) if done else p1
+        parts, scan = pieces(a, b, done)
+        if done: scan = p1
+        for a, b in parts:
+            page = add(a, b)
+            if page: yield page
+
+    for block in itertools.chain(blocks, [None]):
+        done = block is None
+        if not done:
+            keep = min(cur_c, scan)
+            buf, base = buf[keep - base:] + block, keep
+        end = base + len(buf)
+        while True:
+            m = _PARA_SEP_RE.search(buf, scan - base)
+            if not m: break
+            yield from paragraph(scan, m.start() + base, True)
+            scan = m.end() + base
+        yield from paragraph(scan, end, done)
+    if page_a >= 0:
+        yield page_a, page_b, to_bytes(page_a), to_bytes(page_b)
+
+
+def _page_spans(text: str, page_chars: int = 1200) -> List[Tuple[int, int]]:
+    """Страницы как срезы text (символьные смещения), см. _iter_page_spans."""
+    return [(a, b) for a, b, _, _ in _iter_page_spans([text], page_chars)]
+
+
+def _iter_file_text(path: str, block_bytes: int = 1024 * 1024) -> Iterator[str]:
+    """UTF-8 файл кусками по block_bytes (символ на границе блоков не рвётся)."""
+    dec = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        while chunk := f.read(block_bytes):
+            yield dec.decode(chunk)
+    tail = dec.decode(b"", final=True)
+    if tail: yield tail
+
+
+# =========================
+#  Чанки: фрагменты с перекрытием для контекста чата и отрывков для игр
+# =========================
+CHUNK_UNIT = os.getenv("CHUNK_UNIT", "chars")  # chars | tokens
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1200"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+CHUNK_CHARS_PER_TOKEN = float(os.getenv("CHUNK_CHARS_PER_TOKEN", "3"))  # грубая оценка для русского текста
+
+
+def _chunk_chars(n: int) -> int:
+    """CHUNK_SIZE/CHUNK_OVERLAP заданы в символах или в примерных токенах — переводим в символы."""
+    return int(n * CHUNK_CHARS_PER_TOKEN) if CHUNK_UNIT == "tokens" else n
+
+
+def _approx_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHUNK_CHARS_PER_TOKEN)
+
+
+def _chunk_cut(text: str, a: int, b: int, floor: int = 0) -> int:
+    """Конец фрагмента, начатого в a, не дальше b и не раньше floor (иначе перекрытие съест прогресс):
+    граница абзаца во второй половине окна, иначе последний конец предложения, иначе пробел, иначе b."""
+    floor = max(floor, a + 1)
+    para = text.rfind("\n\n", max(floor, a + (b - a) // 2), b)
+    if para != -1: return para
+    last = None
+    for last in _SENTENCE_END_RE.finditer(text, max(floor, a + (b - a) // 4), b): pass
+    if last: return last.end()
+    for last in _WORD_END_RE.finditer(text, floor - 1, b): pass
+    return last.end() if last else b
+
+
+def _chunk_spans(text: str, size: int = 1200, overlap: int = 200) -> List[Tuple[int, int]]:
+    """Фрагменты одной главы (символьные смещения) не длиннее size; следующий начинается с начала
+    предложения в последних overlap символах предыдущего. Главу вызывающий передаёт целиком,
+    так что фрагмент не захватывает соседнюю главу."""
+    size = max(1, size)
+    overlap = min(max(0, overlap), size // 2)
+    n, spans = len(text), []
+    m = _NON_WS_RE.search(text)
+    start, end = (m.start() if m else n), 0
+    while start < n:
+        end = n if n - start <= size else _chunk_cut(text, start, start + size, end + 1)
+        end = start + len(text[start:end].rstrip())
+        spans.append((start, end))
+        if not _NON_WS_RE.search(text, end): break
+        pos = end
+        if overlap:
+            lo = max(start + 1, end - overlap)
+            m = _SENTENCE_END_RE.search(text, lo, end)
+            sp = text.find(" ", lo, end)
+            pos = m.end() if m else (sp if sp != -1 else end)
+        start = _NON_WS_RE.search(text, pos).start()
+    return spans
+
+
+def _byte_spans(text: str, spans: List[Tuple[int, int]], base: int = 0) -> List[List[int]]:
+    """Символьные смещения в text -> байтовые (UTF-8) со сдвигом base; один проход по тексту."""
+    offsets, c, b = {}, 0, 0
+    for p in sorted({x for span in spans for x in span}):
+        b += len(text[c:p].encode("utf-8")); c = p
+        offsets[p] = b
+    return [[base + offsets[s], base + offsets[e]] for s, e in spans]
+
+
+def _chunk_pages(pages: List[List[int]], chunks: List[List[int]]) -> List[int]:
+    """Номер страницы (с 0), на которой начинается каждый чанк: и те и другие — байтовые смещения в text.txt."""
+    starts = [a for a, _ in pages]
+    return [max(0, bisect.bisect_right(starts, a) - 1) for a, _ in chunks]
+
+
+# =========================
+#  Инвертированный индекс (BM25)
+# =========================
+INDEX_VERSION = 3
+BM25_K1, BM25_B = 1.2, 0.75
+PASSAGE_CHARS = int(os.getenv("PASSAGE_CHARS", "700"))
+PASSAGE_OVERLAP = int(os.getenv("PASSAGE_OVERLAP", "200"))
+_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё0-9]+")
+
+def _tokenize(s: str) -> List[str]:
+    return [w.lower() for w in _WORD_RE.findall(s or "")]
+
+
+def _passage_spans(pages: List[str], size: int = PASSAGE_CHARS, overlap: int = PASSAGE_OVERLAP) -> List[List[int]]:
+    """Перекрывающиеся окна внутри страниц: [номер страницы, start, end]. Границы — по пробелам."""
+    spans: List[List[int]] = []
+    step = max(1, size - overlap)
+    for p, text in enumerate(pages):
+        n, start = len(text), 0
+        while start < n:
+            end = min(n, start + size)
+            if end < n:
+                cut = text.rfind(" ", start + step, end)
+                if cut > start: end = cut
+            spans.append([p, start, end])
+            if end >= n: break
+            nxt = text.find(" ", max(start + 1, end - overlap), end)
+            start = nxt + 1 if nxt != -1 else end
+    return spans
+
+
+class _IndexBuilder:
+    """Индекс по частям: тексты глав, страниц и чанков подаются по одному, по мере появления, —
+    в памяти копятся только постинги, документ целиком не нужен."""
+
+    def __init__(self, units: Tuple[str, ...] = ("chapters", "pages", "passages", "chunks")):
+        self.units = {name: {"postings": {}, "lens": []} for name in units}
+        self.spans: List[List[int]] = []
+        self.pages = 0
+
+    def add(self, name: str, text: str) -> None:
+        unit = self.units.get(name)
+        if unit is None: return
+        tf = Counter(_tokenize(text))
+        i = len(unit["lens"])
+        unit["lens"].append(sum(tf.values()))
+        for term, n in tf.items():
+            unit["postings"].setdefault(term, []).append([i, n])
+
+    def add_page(self, text: str) -> None:
+        self.add("pages", text)
+        if "passages" in self.units:
+            for _, a, b in _passage_spans([text]):
+                self.spans.append([self.pages, a, b])
+                self.add("passages", text[a:b])
+        self.pages += 1
+
+    def result(self) -> Dict[str, Any]:
+        """term -> [[номер главы/страницы/пассажа/чанка, tf], ...] + длины единиц для нормировки BM25."""
+        out: Dict[str, Any] = {"version": INDEX_VERSION, "units": {}}
+        for name, unit in self.units.items():
+            lens = unit["lens"]
+            out["units"][name] = {
+                "n": len(lens),
+                "avgdl": (sum(lens) / len(lens)) if lens else 0.0,
+                "lens": lens,
+                "postings": unit["postings"],
+            }
+        if "passages" in self.units:
+            out["units"]["passages"]["spans"] = self.spans
+        return out
+
+
+def _build_index(doc: Dict[str, Any], units: Tuple[str, ...] = ("chapters", "pages", "passages", "chunks")) -> Dict[str, Any]:
+    """Индекс по уже развёрнутому документу (чат без index.json, старые data.json)."""
+    b = _IndexBuilder(units)
+    for c in doc.get("chapters") or []: b.add("chapters", c.get("text") or "")
+    for page in doc.get("pages") or []: b.add_page(page)
+    for chunk in doc.get("chunks") or []: b.add("chunks", chunk)
+    return b.result()
+
+
+def _bm25(unit: Dict[str, Any], query_words: List[str]) -> Dict[int, float]:
+    """Скоринг по постингам: трогаем только единицы, где встречаются слова запроса."""
+    n, avgdl, lens, postings = unit["n"], unit["avgdl"] or 1.0, unit["lens"], unit["postings"]
+    scores: Dict[int, float] = {}
+    for q in set(query_words):
+        plist = postings.get(q)
+        if not plist: continue
+        idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+        for i, tf in plist:
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * lens[i] / avgdl)
+            scores[i] = scores.get(i, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+    return scores
+
+
+def _save_index(doc_dir: str, index: Dict[str, Any]) -> Dict[str, Any]:
+    # через tmp + rename: параллельная пересборка в другом воркере не прочтёт недописанный файл
+    _write_json_atomic(os.path.join(doc_dir, "index.json"), index, separators=(",", ":"))
+    return index
+
+
+def _write_index(doc_dir: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    return _save_index(doc_dir, _build_index(doc))
+
+
+# =========================
+#  Формат документа на диске: text.txt + doc.json
+# =========================
+# Текст хранится один раз (text.txt, UTF-8), doc.json — компактное описание с байтовыми
+# смещениями глав и страниц в text.txt. Страницу или главу можно прочитать seek'ом, не
+# поднимая весь документ; полный data.json старого формата собирается на лету.
+DOC_FORMAT_VERSION = 1
+PAGE_CHARS = 1200
+CHAPTER_PREVIEW_CHARS = 400
+
+
+def _write_json_atomic(path: str, data: Any, **kw) -> None:
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **kw)
+    os.replace(tmp, path)
+
+
+def _index_text_file(path: str, compact: Dict[str, Any]) -> Dict[str, Any]:
+    """Индекс по text.txt и его разметке: главы, страницы и чанки читаются с диска по одному."""
+    index = _IndexBuilder()
+    with open(path, "rb") as f:
+        def read(a: int, b: int) -> str:
+            f.seek(a); return f.read(b - a).decode("utf-8")
+        for c in compact["chapters"]: index.add("chapters", read(c["start"], c["end"]))
+        for a, b in compact["pages"]: index.add_page(read(a, b))
+        for a, b in compact["chunks"]: index.add("chunks", read(a, b))
+    return index.result()
+
+
+def _write_doc(doc_dir: str, meta: Dict[str, Any], chapters: Iterable[Dict[str, Any]], with_index: bool = False,
+               trace_id: Optional[str] = None) -> Dict[str, Any]:
+    """Записывает text.txt (главы по одной, без общей склейки в памяти) и doc.json; страницы
+    размечаются потоковым проходом по записанному файлу. Оба файла — через tmp + rename, doc.json
+    последним: он и есть «версия» документа. with_index — следом собирает index.json, читая
+    text.txt по кускам, без разворачивания документа. Этапы paginate, json_dump и index_build
+    попадают в /metrics. Возвращает doc.json."""
+    tmp = os.path.join(doc_dir, f"text.txt.{os.getpid()}.{threading.get_ident()}.tmp")
+    size, overlap = _chunk_chars(CHUNK_SIZE), _chunk_chars(CHUNK_OVERLAP)
+    ch_meta, chunks, pos = [], [], 0
+    with open(tmp, "wb") as f:
+        for i, ch in enumerate(chapters):
+            body = _normalize_text(ch.get("text") or "")
+            raw = body.encode("utf-8")
+            if i:
+                f.write(b"\n\n"); pos += 2  # между главами
+            ch_meta.append({"title": ch.get("title") or "", "start": pos, "end": pos + len(raw),
+                            "preview": body[:CHAPTER_PREVIEW_CHARS]})
+            chunks += _byte_spans(body, _chunk_spans(body, size, overlap), pos)
+            f.write(raw); pos += len(raw)
+    with METRICS.stage("paginate", trace_id):
+        pages = [[bs, be] for _, _, bs, be in _iter_page_spans(_iter_file_text(tmp), PAGE_CHARS)]
+    os.replace(tmp, os.path.join(doc_dir, "text.txt"))
+    compact = {**meta, "version": DOC_FORMAT_VERSION, "chapters": ch_meta, "pages_count": len(pages), "pages": pages,
+               "chunking": {"size": size, "overlap": overlap}, "chunks": chunks}
+    with METRICS.stage("json_dump", trace_id):
+        _write_json_atomic(os.path.join(doc_dir, "doc.json"), compact, separators=(",", ":"))
+    if with_index:
+        with METRICS.stage("index_build", trace_id):  # после doc.json: индекс не старше документа
+            _save_index(doc_dir, _index_text_file(os.path.join(doc_dir, "text.txt"), compact))
+    return compact
+
+
+def _expand_doc(compact: Dict[str, Any], raw: bytes) -> Dict[str, Any]:
+    """doc.json + байты text.txt -> прежний формат data.json (главы и страницы текстом)
+    плюс чанки и номера их страниц для чата (в отдаваемый data.json они не попадают)."""
+    doc = {k: v for k, v in compact.items() if k not in ("version", "chapters", "pages", "pages_count", "chunking", "chunks")}
+    doc["chapters"] = [{"title": c["title"], "text": raw[c["start"]:c["end"]].decode("utf-8")} for c in compact["chapters"]]
+    doc["pages"] = [raw[a:b].decode("utf-8") for a, b in compact["pages"]]
+    if compact.get("chunks"):
+        doc["chunks"] = [raw[a:b].decode("utf-8") for a, b in compact["chunks"]]
+        doc["chunk_pages"] = _chunk_pages(compact["pages"], compact["chunks"])
+    return doc
+
+
+def _load_doc(doc_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(doc_dir, "doc.json"), "r", encoding="utf-8") as f:
+        compact = json.load(f)
+    with open(os.path.join(doc_dir, "text.txt"), "rb") as f:
+        return _expand_doc(compact, f.read())
+
+
+@functools.lru_cache(maxsize=256)
+def _doc_layout(doc_json: str, mtime_ns: int) -> Dict[str, Any]:
+    # mtime_ns — часть ключа кэша: перезаписанный doc.json читается заново
+    with open(doc_json, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_ranges(doc_dir: str, spans: List[List[int]]) -> List[str]:
+    """Читает из text.txt только нужные куски."""
+    out = []
+    with open(os.path.join(doc_dir, "text.txt"), "rb") as f:
+        for a, b in spans:
+            f.seek(a)
+            out.append(f.read(b - a).decode("utf-8"))
+    return out
+
+
+def _doc_layout_for(doc_dir: str) -> Optional[Dict[str, Any]]:
+    path = os.path.join(doc_dir, "doc.json")
+    try:
+        return _doc_layout(path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
 
 
 # =========================
@@ -442,28 +1331,261 @@ SAMPLE_DOCS = {
 }
 
 
-def _build_sample_data(cfg: Dict[str, Any]) -> Dict[str, Any]:
-    chapters = cfg["chapters"]
-    full_text = "\n\n".join((c.get("text") or "") for c in chapters)
+def _sample_meta(cfg: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "title": cfg["title"],
         "size": cfg["size"],
         "meta": cfg["meta"],
-        "chapters": chapters,
         "conspect": cfg.get("conspect", []),
         "qa": [],  # GPT вместо статичного Q&A
-        "pages": _simple_pages(full_text, page_chars=1200),
     }
 
-def ensure_samples():
+SAMPLES_CATALOG = os.path.join(SAMPLES_ROOT, "catalog.json")
+SAMPLES_PREBUILT = str(os.getenv("SAMPLES_PREBUILT", "")).strip().lower() in ("1", "true", "yes", "on")
+_SAMPLES: Dict[str, Any] = {"items": None}  # каталог для /samples, собирается один раз
+
+
+def _sample_hash(cfg: Dict[str, Any]) -> str:
+    """Хэш исходника сэмпла вместе с тем, что влияет на результат (формат, размер страницы и чанков)."""
+    raw = json.dumps({"cfg": cfg, "format": DOC_FORMAT_VERSION, "page_chars": PAGE_CHARS,
+                      "chunking": [_chunk_chars(CHUNK_SIZE), _chunk_chars(CHUNK_OVERLAP)]}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _read_catalog() -> Dict[str, Any]:
+    try:
+        with open(SAMPLES_CATALOG, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def ensure_samples(force: bool = False, with_index: bool = False) -> List[Dict[str, Any]]:
+    """Пересобирает только сэмплы, у которых поменялся исходник (по хэшу из samples/catalog.json).
+    Запись — через tmp + rename, так что параллельные воркеры не видят полузаписанных файлов.
+    SAMPLES_PREBUILT=1 — доверяем готовому каталогу и ничего не проверяем."""
+    catalog = {} if force else _read_catalog()
+    if SAMPLES_PREBUILT and catalog.get("items"):
+        return catalog["items"]
+    known = {it["slug"]: it for it in catalog.get("items", [])}
+    items, changed = [], False
     for slug, cfg in SAMPLE_DOCS.items():
+        h = _sample_hash(cfg)
         sd = os.path.join(SAMPLES_ROOT, slug)
-        os.makedirs(sd, exist_ok=True)
-        data_path = os.path.join(sd, "data.json")
-        with open(data_path, "w", encoding="utf-8") as f:
-            json.dump(_build_sample_data(cfg), f, ensure_ascii=False, indent=2)
+        if known.get(slug, {}).get("source_hash") != h or not os.path.isfile(os.path.join(sd, "doc.json")):
+            os.makedirs(sd, exist_ok=True)
+            # без with_index index.json соберётся при первом вопросе
+            _write_doc(sd, _sample_meta(cfg), cfg["chapters"], with_index=with_index)
+            changed = True
+        items.append({"slug": slug, "title": cfg["title"], "size": cfg["size"], "meta": cfg["meta"], "source_hash": h})
+    if changed or len(items) != len(known):
+        _write_json_atomic(SAMPLES_CATALOG, {"items": items}, indent=1)
+    return items
+
+
+def _samples_items() -> List[Dict[str, Any]]:
+    if _SAMPLES["items"] is None:
+        _SAMPLES["items"] = [{
+            "slug": it["slug"],
+            "title": it["title"],
+            "size": it["size"],
+            "meta": it["meta"],
+            "doc_url": f"/samples/{it['slug']}/doc.json",
+            "json_url": f"/samples/{it['slug']}/data.json",
+        } for it in ensure_samples()]
+    return _SAMPLES["items"]
 
-ensure_samples()
+
+# =========================
+#  Хранилище документов (in-process, LRU)
+# =========================
+DOC_STORE_MAX_BYTES = int(os.getenv("DOC_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+_SAFE_ID_RE = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+# размеры объектов в памяти: постинг [номер, tf] и пассаж [страница, начало, конец] — списки из int
+# (tf почти всегда меньше 257 — такие int в CPython общие и места не занимают)
+_PAIR_BYTES = sys.getsizeof([0, 0]) + sys.getsizeof(1 << 20) + 8
+_TRIPLE_BYTES = sys.getsizeof([0, 0, 0]) + 3 * sys.getsizeof(1 << 20) + 8
+
+
+def _doc_mem_bytes(doc: Dict[str, Any]) -> int:
+    """Сколько развёрнутый документ занимает в памяти: строки глав, страниц и чанков (кириллица в str —
+    2 байта на символ, поэтому это заметно больше text.txt) плюс списки под них."""
+    chapters = doc.get("chapters") or []
+    strs = itertools.chain((c.get("text") or "" for c in chapters), doc.get("pages") or [], doc.get("chunks") or [])
+    n = sum(sys.getsizeof(t) for t in strs) + sys.getsizeof(chapters) * 2
+    n += sum(sys.getsizeof(doc.get(k) or []) for k in ("pages", "chunks", "chunk_pages"))
+    return n + len(doc.get("chunk_pages") or []) * sys.getsizeof(1 << 20)
+
+
+def _index_mem_bytes(index: Dict[str, Any]) -> int:
+    """То же для разобранного index.json: словари постингов, списки длин и спаны пассажей."""
+    n = 0
+    for unit in (index.get("units") or {}).values():
+        postings, lens = unit.get("postings") or {}, unit.get("lens") or []
+        n += sys.getsizeof(postings) + sys.getsizeof(lens) + len(lens) * sys.getsizeof(1 << 20)
+        n += sum(sys.getsizeof(t) + sys.getsizeof(pl) + len(pl) * _PAIR_BYTES for t, pl in postings.items())
+        n += len(unit.get("spans") or []) * _TRIPLE_BYTES
+    return n
+
+
+class DocStore:
+    """Кэш развёрнутых документов: ключ — путь к doc.json (или data.json старых загрузок),
+    вытеснение LRU по объёму, который документ и его индекс реально занимают в памяти. Запись
+    инвалидируется, если у файла поменялись mtime/размер. Индекс (index.json рядом) подгружается
+    лениво при первом вопросе."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._builds: Dict[str, threading.Lock] = {}  # путь -> lock сборки индекса: строим один раз
+
+    def _entry(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.drop(path)
+            return None
+        sig = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            item = self._items.get(path)
+            if item and item["sig"] == sig:
+                self._items.move_to_end(path)
+                return item
+        if os.path.basename(path) == "doc.json":
+            doc = _load_doc(os.path.dirname(path))
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                doc = json.load(f)
+        item = {"sig": sig, "size": _doc_mem_bytes(doc), "doc": doc, "index": None}
+        with self._lock:
+            self._put(path, item)
+        return item
+
+    def _put(self, path: str, item: Dict[str, Any]) -> None:
+        old = self._items.pop(path, None)
+        if old: self._bytes -= old["size"]
+        self._items[path] = item
+        self._bytes += item["size"]
+        self._shrink()
+
+    def _shrink(self) -> None:
+        # последний документ держим всегда, даже если он один больше лимита
+        while self._bytes > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self._bytes -= evicted["size"]
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        item = self._entry(path)
+        return item["doc"] if item else None
+
+    def signature(self, path: str) -> Optional[Tuple[int, int]]:
+        """(mtime_ns, size) doc.json/data.json, по которому закэширован документ — для инвалидации ответов."""
+        item = self._entry(path)
+        return item["sig"] if item else None
+
+    def index(self, path: str) -> Optional[Dict[str, Any]]:
+        item = self._entry(path)
+        if not item: return None
+        if item["index"] is not None: return item["index"]
+        with self._lock:
+            build = self._builds.setdefault(path, threading.Lock())
+        with build:  # одновременные первые вопросы ждут одну сборку, а не строят каждый свою
+            if item["index"] is None:
+                index = self._load_index(path, item)
+                size = _index_mem_bytes(index)
+                with self._lock:
+                    item["index"] = index
+                    # пока строили, запись могли вытеснить или заменить — тогда её размер уже не наш
+                    if self._items.get(path) is item:
+                        item["size"] += size; self._bytes += size
+                        self._shrink()
+        with self._lock:
+            if self._builds.get(path) is build: self._builds.pop(path, None)
+        return item["index"]
+
+    def _load_index(self, path: str, item: Dict[str, Any]) -> Dict[str, Any]:
+        doc_dir = os.path.dirname(path)
+        idx_path = os.path.join(doc_dir, "index.json")
+        index = None
+        try:
+            if os.stat(idx_path).st_mtime_ns >= item["sig"][0]:
+                with open(idx_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                if index.get("version") != INDEX_VERSION: index = None
+        except (OSError, ValueError):
+            index = None
+        if index is None:
+            # индекса нет или он старше data.json — перестраиваем и сохраняем
+            with METRICS.stage("index_build"):
+                index = _write_index(doc_dir, item["doc"])
+        return index
+
+    def drop(self, path: str) -> None:
+        with self._lock:
+            old = self._items.pop(path, None)
+            if old: self._bytes -= old["size"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+DOC_STORE = DocStore(DOC_STORE_MAX_BYTES)
+
+
+# Загрузки адресуются хэшем содержимого: одинаковые файлы разбираются один раз в uploads/_blobs/{cid},
+# а каждая загрузка получает лишь алиас uploads/_aliases/{doc_id}.json -> cid
+BLOBS_ROOT = os.path.join(UPLOAD_ROOT, "_blobs")
+ALIASES_ROOT = os.path.join(UPLOAD_ROOT, "_aliases")
+CID_CHARS = 32  # 128 бит sha256 — коллизии практически исключены
+
+
+def _shard(root: str, key: str, suffix: str = "") -> str:
+    # root/ab/abcd…: сотни тысяч записей в одной папке замедляют и листинг, и поиск
+    return os.path.join(root, key[:2], key + suffix)
+
+
+def _blob_dir(cid: str) -> str:
+    return _shard(BLOBS_ROOT, cid)
+
+
+def _upload_id_ok(doc_id: str) -> bool:
+    # служебные папки uploads/_* (blobs, aliases, jobs) не выдаём за документы
+    return bool(doc_id) and not doc_id.startswith("_") and bool(_SAFE_ID_RE.match(doc_id))
+
+
+def _read_alias(doc_id: str) -> Optional[Dict[str, Any]]:
+    if not _upload_id_ok(doc_id): return None
+    try:
+        with open(_shard(ALIASES_ROOT, doc_id, ".json"), "r", encoding="utf-8") as f:
+            alias = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return alias if _SAFE_ID_RE.match(str(alias.get("cid") or "")) else None
+
+
+def _doc_dir(doc_id: str = "", slug: str = "") -> Optional[str]:
+    """Папка документа: загрузка по алиасу — общий blob, загрузка старого формата — uploads/{doc_id},
+    сэмпл — samples/{slug} (None — если id некорректный)."""
+    if doc_id:
+        alias = _read_alias(doc_id)
+        doc_dir = _blob_dir(alias["cid"]) if alias else os.path.join(UPLOAD_ROOT, doc_id) if _upload_id_ok(doc_id) else None
+        if doc_dir: _touch(doc_dir)
+        return doc_dir
+    return os.path.join(SAMPLES_ROOT, slug) if slug and _SAFE_ID_RE.match(slug) else None
+
+
+def _doc_path(doc_id: str = "", slug: str = "") -> Optional[str]:
+    """Путь к doc.json документа; у загрузок старого формата — к data.json."""
+    doc_dir = _doc_dir(doc_id, slug)
+    if not doc_dir: return None
+    path = os.path.join(doc_dir, "doc.json")
+    legacy = os.path.join(doc_dir, "data.json")
+    return legacy if not os.path.isfile(path) and os.path.isfile(legacy) else path
 
 
 # =========================
@@ -477,30 +1599,127 @@ def home():
 
 @app.get("/samples")
 def list_samples():
-    items = []
-    for slug, cfg in SAMPLE_DOCS.items():
-        items.append({
-            "slug": slug,
-            "title": cfg["title"],
-            "size": cfg["size"],
-            "meta": cfg["meta"],
-            "json_url": f"/samples/{slug}/data.json"
-        })
-    return {"ok": True, "items": items}
+    return {"ok": True, "items": _samples_items()}
 
 
-@app.get("/samples/{slug}/data.json")
-def serve_sample(slug: str):
-    path = os.path.join(SAMPLES_ROOT, slug, "data.json")
-    if not os.path.isfile(path):
+PAGES_MAX_RANGE = 50
+
+
+def _pages_response(doc_dir: Optional[str], start: int, end: Optional[int]):
+    layout = _doc_layout_for(doc_dir) if doc_dir else None
+    if layout is None:
+        return JSONResponse({"error": "Документ не найден"}, status_code=404)
+    total = layout["pages_count"]
+    start = max(1, start)
+    end = min(total, start + PAGES_MAX_RANGE - 1, end if end is not None else start)
+    pages = _read_ranges(doc_dir, layout["pages"][start - 1:end]) if start <= end else []
+    return {"from": start, "to": start + len(pages) - 1, "total": total, "pages": pages}
+
+
+def _chunks_response(doc_dir: Optional[str], start: int, end: Optional[int]):
+    layout = _doc_layout_for(doc_dir) if doc_dir else None
+    if layout is None or "chunks" not in layout:
+        return JSONResponse({"error": "Документ не найден"}, status_code=404)
+    spans = layout["chunks"]
+    start = max(1, start)
+    end = min(len(spans), start + PAGES_MAX_RANGE - 1, end if end is not None else start)
+    picked = spans[start - 1:end] if start <= end else []
+    texts = _read_ranges(doc_dir, picked)
+    items = [{"n": start + i, "page": p + 1, "tokens": _approx_tokens(t), "text": t}
+             for i, (p, t) in enumerate(zip(_chunk_pages(layout["pages"], picked), texts))]
+    return {"from": start, "to": start + len(items) - 1, "total": len(spans), "chunks": items}
+
+
+def _chapter_response(doc_dir: Optional[str], n: int):
+    layout = _doc_layout_for(doc_dir) if doc_dir else None
+    if layout is None or not 1 <= n <= len(layout["chapters"]):
+        return JSONResponse({"error": "Глава не найдена"}, status_code=404)
+    ch = layout["chapters"][n - 1]
+    return {"n": n, "title": ch["title"], "text": _read_ranges(doc_dir, [[ch["start"], ch["end"]]])[0]}
+
+
+def _legacy_data(doc_dir: Optional[str], extra: Optional[Dict[str, Any]] = None):
+    """data.json старого формата: собираем из doc.json + text.txt (или отдаём файл старой загрузки).
+    extra — поля алиаса (doc_id, title) поверх общего документа."""
+    if not doc_dir:
+        return JSONResponse({"error": "Файл не найден"}, status_code=404)
+    if os.path.isfile(os.path.join(doc_dir, "doc.json")):
+        doc = _load_doc(doc_dir)
+        doc.pop("chunks", None); doc.pop("chunk_pages", None)
+        return JSONResponse({**doc, **(extra or {})})
+    path = os.path.join(doc_dir, "data.json")
+    if os.path.isfile(path):
+        return FileResponse(path, media_type="application/json")
+    return JSONResponse({"error": "Файл не найден"}, status_code=404)
+
+
+@app.get("/samples/{slug}/doc.json")
+def serve_sample_doc(slug: str):
+    doc_dir = _doc_dir(slug=slug)
+    path = os.path.join(doc_dir, "doc.json") if doc_dir else ""
+    if not path or not os.path.isfile(path):
         return JSONResponse({"error": "Файл не найден"}, status_code=404)
     return FileResponse(path, media_type="application/json")
 
 
+@app.get("/samples/{slug}/data.json")
+def serve_sample(slug: str):
+    return _legacy_data(_doc_dir(slug=slug))
+
+
+@app.get("/samples/{slug}/pages")
+def sample_pages(slug: str, start: int = Query(1, alias="from"), to: Optional[int] = None):
+    return _pages_response(_doc_dir(slug=slug), start, to)
+
+
+@app.get("/samples/{slug}/chunks")
+def sample_chunks(slug: str, start: int = Query(1, alias="from"), to: Optional[int] = None):
+    return _chunks_response(_doc_dir(slug=slug), start, to)
+
+
+@app.get("/samples/{slug}/chapters/{n}")
+def sample_chapter(slug: str, n: int):
+    return _chapter_response(_doc_dir(slug=slug), n)
+
+
+@app.get("/files/{doc_id}/pages")
+def doc_pages(doc_id: str, start: int = Query(1, alias="from"), to: Optional[int] = None):
+    """Страницы from..to (с 1, включительно, не больше PAGES_MAX_RANGE за раз)."""
+    return _pages_response(_doc_dir(doc_id=doc_id), start, to)
+
+
+@app.get("/files/{doc_id}/chunks")
+def doc_chunks(doc_id: str, start: int = Query(1, alias="from"), to: Optional[int] = None):
+    """Чанки from..to с номером страницы и примерным числом токенов — готовые отрывки для /generate."""
+    return _chunks_response(_doc_dir(doc_id=doc_id), start, to)
+
+
+@app.get("/files/{doc_id}/chapters/{n}")
+def doc_chapter(doc_id: str, n: int):
+    return _chapter_response(_doc_dir(doc_id=doc_id), n)
+
+
+def _alias_fields(alias: Dict[str, Any]) -> Dict[str, Any]:
+    return {"doc_id": alias["doc_id"], "title": alias.get("filename") or ""}
+
+
 @app.get("/files/{doc_id}/{filename}")
 def files(doc_id: str, filename: str):
-    path = os.path.join(UPLOAD_ROOT, doc_id, filename)
-    if not os.path.isfile(path):
+    alias, doc_dir = _read_alias(doc_id), _doc_dir(doc_id=doc_id)
+    if filename == "data.json":
+        return _legacy_data(doc_dir, _alias_fields(alias) if alias else None)
+    if not alias:
+        path = os.path.join(doc_dir, filename) if doc_dir else ""
+    elif filename == "doc.json":
+        path = os.path.join(doc_dir, "doc.json")
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return JSONResponse({**json.load(f), **_alias_fields(alias)})
+    elif filename == alias.get("filename"):
+        path = os.path.join(doc_dir, alias["source"])
+    else:
+        path = ""
+    if not path or not os.path.isfile(path):
         return JSONResponse({"error": "Файл не найден"}, status_code=404)
     if filename.endswith(".json"):
         return FileResponse(path, media_type="application/json")
@@ -508,125 +1727,1462 @@ def files(doc_id: str, filename: str):
 
 
 # =========================
-#  Upload
+#  Upload: фоновая обработка
 # =========================
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_STALE_SECONDS = int(os.getenv("INGEST_STALE_SECONDS", "300"))  # ingest.lock без пульса дольше — разбор умер
+_INGEST_POOL = ThreadPoolExecutor(max_workers=max(1, INGEST_WORKERS), thread_name_prefix="ingest")
+_INGEST: Dict[str, Dict[str, Any]] = {}  # cid -> статус, пока документ в работе
+_INGEST_LOCK = threading.Lock()
+_UPLOAD_COUNTS = {"hits": 0, "misses": 0}  # hits — файл уже был разобран, нужен только алиас
+_CLAIMED: set = set()  # doc_dir блобов, чей ingest.lock держит этот процесс (пульс — _heartbeat_loop)
+_HEARTBEAT: Dict[str, Any] = {"task": None}
+
+
+def _set_status(doc_dir: str, key: str, persist: bool = True, **fields) -> Dict[str, Any]:
+    """Статус держим в памяти (для частых обновлений прогресса) и в status.json (для других воркеров)."""
+    with _INGEST_LOCK:
+        st = _INGEST.setdefault(key, {})
+        st.update(fields)
+        snap = dict(st)
+        if snap.get("state") in ("done", "error"):
+            _INGEST.pop(key, None)
+    if persist:
+        _write_json_atomic(os.path.join(doc_dir, "status.json"), snap)
+    return snap
+
+
+def _lock_stale(doc_dir: str) -> bool:
+    """ingest.lock нет или его давно не обновляли: воркер, который разбирал блоб, убит."""
+    if doc_dir in _CLAIMED: return False
+    try:
+        return time.time() - os.path.getmtime(os.path.join(doc_dir, "ingest.lock")) > INGEST_STALE_SECONDS
+    except OSError:
+        return True
+
+
+def _claim_ingest(doc_dir: str) -> bool:
+    """Право разбирать блоб — у того, кто создал ingest.lock (O_EXCL атомарен и между воркерами);
+    снимает его _ingest по завершении, брошенный (без пульса) перехватываем."""
+    path = os.path.join(doc_dir, "ingest.lock")
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            _CLAIMED.add(doc_dir)
+            return True
+        except FileExistsError:
+            if not _lock_stale(doc_dir): return False
+            try: os.remove(path)
+            except OSError: pass
+    return False
+
+
+def _release_ingest(doc_dir: str) -> None:
+    _CLAIMED.discard(doc_dir)
+    try: os.remove(os.path.join(doc_dir, "ingest.lock"))
+    except OSError: pass
+
+
+async def _heartbeat_loop() -> None:
+    """Обновляет mtime ingest.lock у всех разборов этого процесса — и в очереди пула, и в работе."""
+    while True:
+        await asyncio.sleep(max(1, INGEST_STALE_SECONDS // 5))
+        now = time.time()
+        for doc_dir in list(_CLAIMED):
+            try: os.utime(os.path.join(doc_dir, "ingest.lock"), (now, now))
+            except OSError: pass
+
+
+def _heartbeat_start() -> None:
+    _HEARTBEAT["task"] = asyncio.create_task(_heartbeat_loop())
+
+
+async def _heartbeat_stop() -> None:
+    task, _HEARTBEAT["task"] = _HEARTBEAT["task"], None
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def _iter_upload_chapters(path: str, ext: str, progress: Callable[[int, int], None]) -> Iterator[Dict[str, Any]]:
+    if ext == "pdf":
+        for idx, ch in enumerate(_iter_text_chunks(_iter_pdf_pages(path, progress), max_chars=16000), 1):
+            yield {"title": f"Фрагмент {idx}", "text": ch, "sections": []}
+        return
+    if ext == "epub":
+        yield from _iter_epub_chapters(path, progress)
+        return
+    if ext == "fb2":
+        yield from _iter_fb2_chapters(path)
+        return
+    yield from _iter_txt_chapters(path)
+
+
+def _ingest(cid: str, doc_dir: str, path: str, name: str, ext: str, size_bytes: int, sha256: str) -> None:
+    """Выполняется в пуле: главы дописываются в chapters.jsonl по мере извлечения, в конце — doc.json."""
+    _set_status(doc_dir, cid, state="running")
+    try:
+        def progress(done: int, total: int) -> None:
+            _set_status(doc_dir, cid, persist=False, pages_done=done, pages_total=total)
+
+        count = 0
+        chapters_path = os.path.join(doc_dir, "chapters.jsonl")
+        with METRICS.stage("parse", cid, format=ext), open(chapters_path, "w", encoding="utf-8") as out:
+            for ch in _iter_upload_chapters(path, ext, progress):
+                out.write(json.dumps(ch, ensure_ascii=False) + "\n"); out.flush()
+                count += 1
+                _set_status(doc_dir, cid, chapters_count=count)
+        if not count:
+            raise RuntimeError("В документе не найден текст")
+
+        chars = 0
+
+        def chapters() -> Iterator[Dict[str, Any]]:
+            # главы идут в _write_doc прямо из chapters.jsonl, списком в памяти не собираются
+            nonlocal chars
+            with open(chapters_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip(): continue
+                    ch = json.loads(line)
+                    chars += len(ch.get("text") or "")
+                    yield ch
+
+        meta = {
+            "title": name,
+            "size": f"{round(size_bytes/1024/1024,2)} MB",
+            "meta": f"загружено • {count} главы",
+            "conspect": [],  # GPT-вкладка вместо статичного Q&A
+            "qa": [],
+            "cid": cid,  # doc_id и title подставляет алиас при отдаче
+            "sha256": sha256,
+        }
+        with METRICS.stage("write_doc", cid):
+            _write_doc(doc_dir, meta, chapters(), with_index=True, trace_id=cid)
+        os.remove(chapters_path)  # текст теперь в text.txt
+        METRICS.observe("document_bytes", size_bytes, SIZE_BUCKETS, format=ext)
+        METRICS.observe("document_chars", chars, SIZE_BUCKETS, format=ext)
+        _set_status(doc_dir, cid, state="done", chapters_count=count)
+    except Exception as e:
+        _set_status(doc_dir, cid, state="error", error="Не удалось обработать документ", details=redact(str(e)))
+    finally:
+        _release_ingest(doc_dir)
+
+
+def _status_at(key: str, doc_dir: str) -> Optional[Dict[str, Any]]:
+    with _INGEST_LOCK:
+        st = _INGEST.get(key)
+        if st: return dict(st)
+    try:
+        with open(os.path.join(doc_dir, "status.json"), "r", encoding="utf-8") as f:
+            st = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if st.get("state") in ("queued", "running") and _lock_stale(doc_dir):
+        # разбор в другом процессе, но его lock без пульса — процесс убит; повторная загрузка разберёт заново
+        return {**st, "state": "error", "error": "Обработка прервалась",
+                "details": "Воркер, разбиравший документ, остановлен — загрузите файл ещё раз"}
+    return st
+
+
+def _read_status(doc_id: str) -> Optional[Dict[str, Any]]:
+    alias = _read_alias(doc_id)
+    if alias:
+        st = _status_at(alias["cid"], _blob_dir(alias["cid"]))
+        return {**st, "doc_id": doc_id, "filename": alias.get("filename")} if st else None
+    if not _upload_id_ok(doc_id): return None
+    doc_dir = os.path.join(UPLOAD_ROOT, doc_id)
+    st = _status_at(doc_id, doc_dir)
+    if st: return st
+    # загрузки, сделанные до появления статусов
+    if os.path.isfile(os.path.join(doc_dir, "doc.json")) or os.path.isfile(os.path.join(doc_dir, "data.json")):
+        return {"doc_id": doc_id, "state": "done"}
+    return None
+
+
+class _UploadTooLarge(Exception):
+    pass
+
+
+def _too_large_response() -> JSONResponse:
+    return JSONResponse({"ok": False, "error": "Файл слишком большой",
+                         "details": f"Максимум {round(UPLOAD_MAX_BYTES/1024/1024, 2)} MB"}, status_code=413)
+
+
+async def _save_upload(file: UploadFile, path: str) -> Tuple[int, str]:
+    """Копирует загрузку на диск кусками UPLOAD_CHUNK_BYTES и считает sha256 на лету —
+    в памяти не больше одного куска. При превышении UPLOAD_MAX_BYTES частичный файл удаляется."""
+    h, size = hashlib.sha256(), 0
+    try:
+        with open(path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise _UploadTooLarge()
+                h.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        try: os.remove(path)
+        except OSError: pass
+        raise
+    return size, h.hexdigest()
+
+
+class _UploadLimitMiddleware:
+    """Отсекает слишком большие загрузки до разбора multipart: по Content-Length сразу,
+    без него (chunked) — по мере чтения тела. Иначе Starlette успел бы сложить весь файл во временный."""
+
+    def __init__(self, app_):
+        self.app = app_
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/upload":
+            return await self.app(scope, receive, send)
+        limit = UPLOAD_MAX_BYTES + UPLOAD_FORM_SLACK
+        length = dict(scope.get("headers") or []).get(b"content-length")
+        if length and length.isdigit() and int(length) > limit:
+            return await _too_large_response()(scope, receive, send)
+
+        state = {"received": 0, "tripped": False}
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > limit:
+                    state["tripped"] = True
+                    raise _UploadTooLarge()
+            return message
+
+        async def send_wrapper(message):
+            # FastAPI превращает ошибку чтения тела в 400 — подменяем её на 413
+            if not state["tripped"]:
+                await send(message)
+            elif message["type"] == "http.response.start":
+                await _too_large_response()(scope, receive, send)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except _UploadTooLarge:
+            await _too_large_response()(scope, receive, send)
+
+
+app.add_middleware(_UploadLimitMiddleware)
+
+
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     name = file.filename or ""
     if not _allowed_file(name):
         return JSONResponse({"ok": False, "error": "Допустимы: PDF, EPUB, FB2, TXT"}, status_code=415)
 
-    doc_id = str(uuid.uuid4())[:8]
-    doc_dir = os.path.join(UPLOAD_ROOT, doc_id)
-    os.makedirs(doc_dir, exist_ok=True)
-
+    doc_id = uuid.uuid4().hex[:16]
     ext = name.rsplit(".", 1)[1].lower()
-    path = os.path.join(doc_dir, name)
-    raw_bytes = await file.read()
-    with open(path, "wb") as out:
-        out.write(raw_bytes)
+    if ext == "pdf" and not _available("fitz"):
+        return JSONResponse({"ok": False, "error": "Не удалось обработать документ", "details": "PyMuPDF не установлен (pip install pymupdf)", "trace_id": doc_id}, status_code=500)
 
+    os.makedirs(BLOBS_ROOT, exist_ok=True)
+    tmp = os.path.join(BLOBS_ROOT, f".upload-{doc_id}")
     try:
-        chapters: List[Dict[str, Any]] = []
-        if ext == "pdf":
-            if not fitz:
-                raise RuntimeError("PyMuPDF не установлен (pip install pymupdf)")
-            chunks = _pdf_to_text_chunks(path, max_chars=16000)[:CHUNK_LIMIT]
-            for idx, ch in enumerate(chunks, 1):
-                chapters.append({"title": f"Фрагмент {idx}", "text": ch, "sections": []})
-        else:
-            text = raw_bytes.decode("utf-8", errors="ignore")
-            # делим пополам = 2 фрагмента для быстрого прототипа
-            half = max(1, len(text)//5)
-            chapters = [
-                {"title": "Часть 1", "text": text[:half], "sections": []},
-                {"title": "Часть 2", "text": text[half:], "sections": []},
-            ]
-
-        full_text = "\n\n".join((c.get("text") or "") for c in chapters)
-        data = {
-            "title": name,
-            "size": f"{round(len(raw_bytes)/1024/1024,2)} MB",
-            "meta": f"загружено • {len(chapters)} главы",
-            "chapters": chapters,
-            "conspect": [],  # GPT-вкладка вместо статичного Q&A
-            "qa": [],
-            "pages": _simple_pages(full_text, page_chars=1200),
-            "doc_id": doc_id,
-        }
-
-        out_json = os.path.join(doc_dir, "data.json")
-        with open(out_json, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-
-    except Exception as e:
-        return JSONResponse({"ok": False, "error": "Не удалось обработать документ", "details": redact(str(e)), "trace_id": doc_id}, status_code=500)
+        with METRICS.stage("upload_save", doc_id):
+            size_bytes, sha256 = await _save_upload(file, tmp)
+    except _UploadTooLarge:
+        return _too_large_response()
+
+    cid = sha256[:CID_CHARS]
+    doc_dir = _blob_dir(cid)
+    source = f"source.{ext}"
+    # в очередь ставит только тот, кто захватил ingest.lock: иначе два воркера (или два повтора
+    # после error) разбирали бы один блоб параллельно
+    os.makedirs(doc_dir, exist_ok=True)
+    st = _status_at(cid, doc_dir)
+    claimed = (st is None or st.get("state") == "error") and _claim_ingest(doc_dir)
+    if claimed:
+        st = _status_at(cid, doc_dir)  # пока захватывали, предыдущий разбор мог завершиться
+        if st and st.get("state") not in ("error", "queued", "running"):
+            _release_ingest(doc_dir)
+            claimed = False
+    if claimed:
+        os.replace(tmp, os.path.join(doc_dir, source))
+        st = _set_status(doc_dir, cid, state="queued", cid=cid, filename=name, sha256=sha256,
+                         pages_done=0, pages_total=None, chapters_count=0)
+        asyncio.get_running_loop().run_in_executor(_INGEST_POOL, _ingest, cid, doc_dir, os.path.join(doc_dir, source),
+                                                   name, ext, size_bytes, sha256)
+        _UPLOAD_COUNTS["misses"] += 1
+        deduplicated = False
+    else:
+        os.remove(tmp)
+        st = st or {"state": "queued"}  # lock уже взят другим воркером, статус ещё не записан
+        _UPLOAD_COUNTS["hits"] += 1
+        deduplicated = True
+        await asyncio.to_thread(_touch, doc_dir)  # возможна распаковка холодного документа
+        source = next((f.removesuffix(".gz") for f in os.listdir(doc_dir) if f.startswith("source.")), source)
+
+    alias_path = _shard(ALIASES_ROOT, doc_id, ".json")
+    os.makedirs(os.path.dirname(alias_path), exist_ok=True)
+    _write_json_atomic(alias_path, {"doc_id": doc_id, "cid": cid, "filename": name, "source": source, "created": int(time.time())})
+    with open(os.path.join(doc_dir, "aliases.txt"), "a", encoding="utf-8") as f:
+        f.write(doc_id + "\n")  # чтобы при вытеснении удалить алиасы без обхода _aliases/
 
     return JSONResponse({
         "ok": True,
         "doc_id": doc_id,
+        "cid": cid,
+        "deduplicated": deduplicated,
         "filename": name,
+        "doc_url": f"/files/{doc_id}/doc.json",
         "json_url": f"/files/{doc_id}/data.json",
-        "chapters_count": len(data.get("chapters", []))
+        "status_url": f"/upload/{doc_id}/status",
+        "status": st.get("state", "queued"),
     })
 
 
+def _upload_stats() -> Dict[str, Any]:
+    # число документов — из последнего прохода обслуживания: обходить uploads/ на каждый опрос дорого
+    by_kind = _MAINT["report"].get("by_kind") or {}
+    return {**_UPLOAD_COUNTS, "entries": (by_kind.get("blob") or {}).get("count", 0)}
+
+
+@app.get("/upload/{doc_id}/status")
+def upload_status(doc_id: str):
+    st = _read_status(doc_id)
+    if st is None:
+        return JSONResponse({"error": "Документ не найден"}, status_code=404)
+    if st.get("state") == "done":
+        if os.path.isfile(os.path.join(_doc_dir(doc_id=doc_id), "doc.json")):
+            st["doc_url"] = f"/files/{doc_id}/doc.json"
+        st["json_url"] = f"/files/{doc_id}/data.json"
+    return st
+
+
+# =========================
+#  Обслуживание uploads/: квота, TTL, сжатие холодных документов
+# =========================
+UPLOADS_MAX_BYTES = int(os.getenv("UPLOADS_MAX_BYTES", str(10 * 1024 ** 3)))   # 0 — без квоты
+UPLOADS_TTL_DAYS = float(os.getenv("UPLOADS_TTL_DAYS", "90"))                  # 0 — хранить вечно
+UPLOADS_COLD_DAYS = float(os.getenv("UPLOADS_COLD_DAYS", "7"))                 # 0 — не сжимать
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "600"))         # 0 — без фоновой задачи
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ACCESS_TOUCH_EVERY = 60      # не чаще раза в минуту обновляем время доступа одной папки
+QUOTA_LOW_WATERMARK = 0.9    # вытесняем с запасом, чтобы не упираться в квоту на каждом проходе
+_COMPRESSIBLE = (".txt", ".fb2", "index.json")  # text.txt, текстовые оригиналы и индекс; PDF/EPUB уже сжаты
+
+_ACCESS: Dict[str, float] = {}  # папка -> когда этот процесс последний раз отметил доступ
+_MAINT: Dict[str, Any] = {"task": None, "report": {}}
+
+
+@contextmanager
+def _doc_lock(doc_dir: str, wait: bool):
+    """Сжатие и распаковка одного документа — по очереди между всеми воркерами: lock-файл рядом с папкой
+    (не внутри: иначе он сдвигал бы mtime, то есть время доступа). wait=False — занят, так занят."""
+    path = doc_dir.rstrip(os.sep) + ".lock"
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > 600: os.remove(path); continue  # брошенный
+            except OSError:
+                continue
+            if not wait:
+                yield False
+                return
+            time.sleep(0.05)
+    try:
+        yield True
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+
+def _touch(doc_dir: str) -> None:
+    """Время последнего доступа — mtime папки документа (по нему TTL и LRU);
+    сжатый холодный документ при обращении распаковывается обратно. Отметку в _ACCESS ставим
+    только после распаковки: параллельный запрос не должен пропустить её и открыть несуществующий text.txt."""
+    now = time.time()
+    if now - _ACCESS.get(doc_dir, 0) < ACCESS_TOUCH_EVERY: return
+    try:
+        os.utime(doc_dir, (now, now))  # до проверки: начавшееся позже сжатие увидит доступ и отступит
+        names = os.listdir(doc_dir)
+    except OSError:
+        return
+    if any(n.endswith(".gz") for n in names) or os.path.exists(doc_dir.rstrip(os.sep) + ".lock"):
+        with _doc_lock(doc_dir, wait=True):
+            _thaw(doc_dir)
+    _ACCESS[doc_dir] = now
+
+
+def _thaw(doc_dir: str) -> None:
+    """Вызывается под _doc_lock, так что .gz не дописывается прямо сейчас."""
+    for name in os.listdir(doc_dir):
+        if not name.endswith(".gz"): continue
+        src, dst = os.path.join(doc_dir, name), os.path.join(doc_dir, name[:-3])
+        if os.path.exists(dst):
+            os.remove(src)  # сжатие прервалось до удаления оригинала — оригинал и оставляем
+            continue
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(src, "rb") as fin, open(tmp, "wb") as fout:
+                shutil.copyfileobj(fin, fout, UPLOAD_CHUNK_BYTES)
+            os.replace(tmp, dst)
+            os.remove(src)
+        except (OSError, EOFError, zlib.error) as e:  # gzip.BadGzipFile — это OSError
+            try: os.remove(tmp)
+            except OSError: pass
+            logging.getLogger("uvicorn.error").warning("thaw %s: %s", src, e)
+
+
+def _freeze(doc_dir: str, atime: Optional[float] = None) -> bool:
+    """Холодный документ: старый data.json — в doc.json + text.txt, текст, текстовый оригинал и index.json —
+    в .gz. Индекс не удаляем: иначе первый вопрос после разморозки ждал бы его пересборки.
+    Идёт под _doc_lock; если папку трогали после atime (или lock занят распаковкой) — не сжимаем."""
+    with _doc_lock(doc_dir, wait=False) as locked:
+        if not locked or (atime is not None and os.stat(doc_dir).st_mtime > atime): return False
+        _freeze_files(doc_dir)
+        return True
+
+
+def _freeze_files(doc_dir: str) -> None:
+    legacy = os.path.join(doc_dir, "data.json")
+    if os.path.isfile(legacy):
+        with open(legacy, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        meta = {k: v for k, v in data.items() if k not in ("chapters", "pages")}
+        _write_doc(doc_dir, meta, data.get("chapters") or [], with_index=True)  # старый индекс — по data.json
+        os.remove(legacy)
+    for name in os.listdir(doc_dir):
+        path = os.path.join(doc_dir, name)
+        if name.endswith(_COMPRESSIBLE) and name != "aliases.txt":
+            tmp = f"{path}.gz.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(path, "rb") as fin, gzip.open(tmp, "wb", compresslevel=6) as fout:
+                shutil.copyfileobj(fin, fout, UPLOAD_CHUNK_BYTES)
+            os.replace(tmp, path + ".gz")  # .gz появляется только целиком
+            os.remove(path)
+
+
+def _dir_size(path: str) -> int:
+    try:
+        return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+    except OSError:
+        return 0
+
+
+def _scan_uploads() -> List[Dict[str, Any]]:
+    """Все единицы хранения: blob (по хэшу), legacy (uploads/{doc_id} старого формата), job (игры)."""
+    items: List[Dict[str, Any]] = []
+
+    def add(kind: str, key: str, entry: os.DirEntry) -> None:
+        try:
+            atime = entry.stat().st_mtime
+        except OSError:
+            return
+        items.append({"kind": kind, "key": key, "path": entry.path, "atime": atime, "size": _dir_size(entry.path),
+                      "compressed": kind != "job" and os.path.exists(os.path.join(entry.path, "text.txt.gz"))})
+
+    def dirs(path: str) -> List[os.DirEntry]:
+        try:
+            return [e for e in os.scandir(path) if e.is_dir() and not e.name.startswith(".")]
+        except OSError:
+            return []
+
+    for shard in dirs(BLOBS_ROOT):
+        for e in dirs(shard.path): add("blob", e.name, e)
+    for e in dirs(UPLOAD_ROOT):
+        if not e.name.startswith("_"): add("legacy", e.name, e)
+    for e in dirs(JOBS_ROOT): add("job", e.name, e)
+    return items
+
+
+def _busy(item: Dict[str, Any]) -> bool:
+    """Документ ещё разбирается / игра генерируется — не трогаем."""
+    if item["kind"] == "job":
+        return item["key"] in _JOBS
+    if item["key"] in _INGEST: return True
+    st = _status_at(item["key"], item["path"])
+    return bool(st) and st.get("state") in ("queued", "running")
+
+
+def _evict(item: Dict[str, Any]) -> None:
+    if item["kind"] == "blob":
+        try:
+            with open(os.path.join(item["path"], "aliases.txt"), "r", encoding="utf-8") as f:
+                for doc_id in f.read().split():
+                    try: os.remove(_shard(ALIASES_ROOT, doc_id, ".json"))
+                    except OSError: pass
+        except OSError:
+            pass
+    for name in ("doc.json", "data.json"):
+        DOC_STORE.drop(os.path.join(item["path"], name))
+    shutil.rmtree(item["path"], ignore_errors=True)
+    _ACCESS.pop(item["path"], None)
+
+
+def _usage(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    by_kind: Dict[str, Dict[str, int]] = {}
+    for it in items:
+        k = by_kind.setdefault(it["kind"], {"count": 0, "bytes": 0, "compressed": 0})
+        k["count"] += 1; k["bytes"] += it["size"]; k["compressed"] += int(it["compressed"])
+    return {"total_bytes": sum(it["size"] for it in items), "by_kind": by_kind,
+            "quota_bytes": UPLOADS_MAX_BYTES, "ttl_days": UPLOADS_TTL_DAYS, "cold_days": UPLOADS_COLD_DAYS}
+
+
+@contextmanager
+def _maintenance_lock():
+    """Один проход за раз на все воркеры: lock-файл через O_EXCL, брошенный (старше часа) перехватываем."""
+    path = os.path.join(UPLOAD_ROOT, ".maintenance.lock")
+    try:
+        if time.time() - os.path.getmtime(path) > 3600: os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+
+def _maintenance_run() -> Dict[str, Any]:
+    """Один проход: TTL по последнему доступу, затем LRU до QUOTA_LOW_WATERMARK от квоты,
+    затем сжатие холодных документов и уборка недокачанных загрузок."""
+    with _maintenance_lock() as acquired:
+        if not acquired:
+            return _MAINT["report"]
+        started, now = time.perf_counter(), time.time()
+        items = _scan_uploads()
+        evicted, freed, compressed = 0, 0, 0
+
+        def drop(it: Dict[str, Any]) -> None:
+            nonlocal evicted, freed
+            _evict(it); evicted += 1; freed += it["size"]
+
+        keep = []
+        for it in items:
+            if UPLOADS_TTL_DAYS and now - it["atime"] > UPLOADS_TTL_DAYS * 86400 and not _busy(it):
+                drop(it)
+            else:
+                keep.append(it)
+        total = sum(it["size"] for it in keep)
+        if UPLOADS_MAX_BYTES and total > UPLOADS_MAX_BYTES:
+            survivors = []
+            for it in sorted(keep, key=lambda it: it["atime"]):
+                if total > UPLOADS_MAX_BYTES * QUOTA_LOW_WATERMARK and not _busy(it):
+                    drop(it); total -= it["size"]
+                else:
+                    survivors.append(it)
+            keep = survivors
+        if UPLOADS_COLD_DAYS:
+            for it in keep:
+                if it["kind"] == "job" or it["compressed"] or now - it["atime"] <= UPLOADS_COLD_DAYS * 86400 or _busy(it):
+                    continue
+                try:
+                    if not _freeze(it["path"], it["atime"]): continue  # к документу только что обратились
+                    os.utime(it["path"], (it["atime"], it["atime"]))  # сжатие — не доступ
+                except (OSError, ValueError):
+                    continue
+                compressed += 1
+                it.update(size=_dir_size(it["path"]), compressed=True)
+        try:
+            for e in os.scandir(BLOBS_ROOT):
+                if e.name.startswith(".upload-") and now - e.stat().st_mtime > 3600:
+                    os.remove(e.path)
+        except OSError:
+            pass
+        _ACCESS.clear()
+        _MAINT["report"] = {**_usage(keep), "finished_at": int(now), "duration_s": round(time.perf_counter() - started, 3),
+                            "evicted": evicted, "freed_bytes": freed, "compressed_now": compressed}
+        return _MAINT["report"]
+
+
+async def _maint_loop() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, _maintenance_run)
+        except Exception:
+            pass  # сбой одного прохода не должен останавливать обслуживание
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+
+def _maint_start() -> None:
+    if MAINTENANCE_INTERVAL > 0:
+        _MAINT["task"] = asyncio.create_task(_maint_loop())
+
+
+async def _maint_stop() -> None:
+    task, _MAINT["task"] = _MAINT["task"], None
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@app.get("/admin/usage")
+def admin_usage(request: Request):
+    """Занятое место по видам хранения и итог последнего прохода обслуживания. Нужен ADMIN_TOKEN."""
+    token = request.headers.get("x-admin-token") or request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse({"error": "Доступ запрещён"}, status_code=403)
+    return {**_usage(_scan_uploads()), "uploads": _UPLOAD_COUNTS, "last_maintenance": _MAINT["report"]}
+
+
+# =========================
+#  Общий HTTP-клиент к внешнему API
+# =========================
+_UPSTREAM: Dict[str, Any] = {"client": None, "sem": None, "loop": None}
+
+
+def _http2_enabled() -> bool:
+    # HTTP/2 требует пакет h2 (pip install "httpx[http2]"); без него остаёмся на HTTP/1.1
+    return HTTP2 and importlib.util.find_spec("h2") is not None
+
+
+def _upstream() -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    """Один клиент на процесс: keep-alive и пул соединений вместо TCP+TLS на каждый запрос.
+    Семафор ограничивает число одновременных исходящих вызовов."""
+    loop = asyncio.get_running_loop()
+    if _UPSTREAM["client"] is None or _UPSTREAM["loop"] is not loop:
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                              keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+        _UPSTREAM.update(
+            client=httpx.AsyncClient(timeout=_request_timeout(), limits=limits, http2=_http2_enabled()),
+            sem=asyncio.Semaphore(max(1, UPSTREAM_CONCURRENCY)),
+            loop=loop,
+        )
+    return _UPSTREAM["client"], _UPSTREAM["sem"]
+
+
+async def _upstream_close() -> None:
+    client = _UPSTREAM["client"]
+    _UPSTREAM.update(client=None, sem=None, loop=None)
+    if client is not None:
+        await client.aclose()
+
+
+class UpstreamUnavailable(httpx.HTTPError):
+    """Предохранитель разомкнут: внешний API недавно падал подряд, запрос даже не отправляем."""
+
+
+class _CircuitBreaker:
+    """closed → (UPSTREAM_CB_FAILURES отказов подряд) → open → (через cooldown) → half_open:
+    пропускаем один пробный запрос; успех замыкает цепь, отказ снова размыкает."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = self.rejected = 0
+        self._probe = False
+
+    def before(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                raise UpstreamUnavailable("Внешний API временно недоступен (circuit open)")
+            self.state, self._probe = "half_open", False
+        if self.state == "half_open":
+            if self._probe:
+                self.rejected += 1
+                raise UpstreamUnavailable("Внешний API временно недоступен (идёт пробный запрос)")
+            self._probe = True
+
+    def release(self) -> None:
+        """Попытка не дошла до исхода (отмена задачи, ошибка не от httpx): пробный слот освобождаем,
+        иначе цепь навсегда застрянет в half_open."""
+        if self.state == "half_open": self._probe = False
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.state, self.failures, self._probe = "closed", 0, False
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open": self.opens += 1
+            self.state, self.opened_at, self._probe = "open", time.monotonic(), False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures, "opens": self.opens, "rejected": self.rejected}
+
+
+class _AdaptiveTimeout:
+    """Таймаут чтения по наблюдаемой задержке, как RTO в TCP: srtt + 4·rttvar (не меньше 2·srtt),
+    в пределах [UPSTREAM_READ_TIMEOUT_MIN, UPSTREAM_READ_TIMEOUT]. Отдельно для чата и генерации."""
+
+    def __init__(self, lo: float, hi: float, min_samples: int = 5):
+        self.lo, self.hi, self.min_samples = lo, hi, min_samples
+        self._est: Dict[str, List[float]] = {}  # kind -> [srtt, rttvar, samples]
+
+    def observe(self, kind: str, seconds: float) -> None:
+        est = self._est.get(kind)
+        if est is None:
+            self._est[kind] = [seconds, seconds / 2, 1]
+            return
+        srtt, var, n = est
+        var = 0.75 * var + 0.25 * abs(srtt - seconds)
+        srtt = 0.875 * srtt + 0.125 * seconds
+        self._est[kind] = [srtt, var, n + 1]
+
+    def read(self, kind: str) -> float:
+        est = self._est.get(kind)
+        if not est or est[2] < self.min_samples: return self.hi
+        srtt, var, _ = est
+        return min(self.hi, max(self.lo, srtt + 4 * var, 2 * srtt))
+
+    def stats(self) -> Dict[str, Any]:
+        return {k: {"srtt": round(v[0], 3), "rttvar": round(v[1], 3), "samples": v[2], "read_timeout": round(self.read(k), 1)}
+                for k, v in self._est.items()}
+
+
+UPSTREAM_BREAKER = _CircuitBreaker(UPSTREAM_CB_FAILURES, UPSTREAM_CB_COOLDOWN)
+UPSTREAM_TIMEOUTS = _AdaptiveTimeout(UPSTREAM_READ_TIMEOUT_MIN, UPSTREAM_READ_TIMEOUT)
+_RETRY_STATUSES = {429, 502, 503, 504}
+_UPSTREAM_COUNTS = {"requests": 0, "retries": 0, "failures": 0}
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Экспоненциальная пауза с полным джиттером; Retry-After от API (в секундах) уважаем, но не дольше потолка."""
+    if retry_after:
+        try: return min(UPSTREAM_BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError: pass
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+
+
+async def _send_resilient(send: Callable[[], Any], kind: str = "chat") -> httpx.Response:
+    """Повторяем только то, что безопасно повторить: соединение не установилось или оборвалось
+    до ответа, либо API ответил 429/502/503/504. Таймаут чтения не повторяем — он и так долгий.
+    Каждая попытка проходит через предохранитель."""
+    attempt = 0
+    while True:
+        UPSTREAM_BREAKER.before()
+        _UPSTREAM_COUNTS["requests"] += 1
+        started = time.perf_counter()
+        try:
+            r = await send()
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError) as e:
+            UPSTREAM_BREAKER.record(False); _UPSTREAM_COUNTS["failures"] += 1
+            METRICS.inc("upstream_errors_total", error=type(e).__name__)
+            if attempt >= UPSTREAM_RETRIES: raise
+            delay = _backoff(attempt)
+        except httpx.HTTPError as e:
+            UPSTREAM_BREAKER.record(False); _UPSTREAM_COUNTS["failures"] += 1
+            METRICS.inc("upstream_errors_total", error=type(e).__name__)
+            raise
+        except BaseException:
+            # отмена (клиент отключился, задача генерации снята) или чужая ошибка — исхода нет
+            UPSTREAM_BREAKER.release()
+            raise
+        else:
+            tid = _current_trace_id()
+            METRICS.observe("upstream_request_duration_seconds", time.perf_counter() - started,
+                            exemplar={"trace_id": tid} if tid else None, kind=kind, status=r.status_code)
+            METRICS.inc("upstream_responses_total", status=r.status_code)
+            METRICS.inc("upstream_sent_bytes_total", len(r.request.content or b""))
+            if r.status_code not in _RETRY_STATUSES:
+                # 4xx — ошибка запроса, а не падение API: цепь не размыкаем
+                UPSTREAM_BREAKER.record(r.status_code < 500)
+                return r
+            UPSTREAM_BREAKER.record(False); _UPSTREAM_COUNTS["failures"] += 1
+            if attempt >= UPSTREAM_RETRIES: return r
+            delay = _backoff(attempt, r.headers.get("retry-after"))
+            await r.aclose()
+        attempt += 1
+        _UPSTREAM_COUNTS["retries"] += 1
+        await asyncio.sleep(delay)
+
+
+def _upstream_error(e: Exception) -> Tuple[str, int]:
+    """Текст ошибки для клиента и HTTP-статус по исключению httpx."""
+    if isinstance(e, UpstreamUnavailable): return "Внешний API временно недоступен", 503
+    if isinstance(e, httpx.TimeoutException): return "Внешний API не ответил вовремя", 504
+    return "Ошибка запроса к внешнему API", 502
+
+
+def _upstream_stats() -> Dict[str, Any]:
+    return {**_UPSTREAM_COUNTS, "circuit": UPSTREAM_BREAKER.stats(), "read_timeouts": UPSTREAM_TIMEOUTS.stats()}
+
+
+class _SingleFlight:
+    """Склейка одинаковых одновременных вызовов: первый запускает задачу, остальные ждут её future.
+    Задача защищена shield — отключение одного клиента не отменяет запрос для остальных."""
+
+    def __init__(self):
+        self._calls: Dict[str, "asyncio.Future[Any]"] = {}
+        self.leaders = self.followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        fut = self._calls.get(key)
+        if fut is None or fut.get_loop() is not asyncio.get_running_loop():
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self._calls.pop(key, None) if self._calls.get(key) is f else None)
+            self.leaders += 1
+        else:
+            self.followers += 1
+        return await asyncio.shield(fut)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._calls)}
+
+
+class _StreamFlights:
+    """То же для потоков: первый подписчик запускает pump, его события (("delta", str), ("end", None),
+    ("error", {...})) раздаются всем подписчикам; подключившийся позже сначала получает уже пришедшие.
+    Pump отменяется, только когда отписались все."""
+
+    def __init__(self):
+        self._flights: Dict[str, Dict[str, Any]] = {}
+        self.leaders = self.followers = 0
+
+    def subscribe(self, key: str, pump: Callable[[Any], Any]) -> "asyncio.Queue[Tuple[str, Any]]":
+        loop = asyncio.get_running_loop()
+        fl = self._flights.get(key)
+        if fl is None or fl["loop"] is not loop:
+            fl = {"loop": loop, "log": [], "queues": [], "done": False}
+            self._flights[key] = fl
+            fl["task"] = asyncio.create_task(pump(_FlightSink(self, key, fl)))
+            fl["task"].add_done_callback(lambda t: self._finish(key, fl, t))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        q: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+        for item in fl["log"]: q.put_nowait(item)
+        fl["queues"].append(q)
+        return q
+
+    def unsubscribe(self, key: str, q: "asyncio.Queue[Tuple[str, Any]]") -> None:
+        fl = self._flights.get(key)
+        if not fl or q not in fl["queues"]: return
+        fl["queues"].remove(q)
+        if not fl["queues"]:
+            self._flights.pop(key, None)
+            fl["task"].cancel()  # клиентов не осталось — вызов наружу больше не нужен
+
+    def _publish(self, key: str, fl: Dict[str, Any], item: Tuple[str, Any]) -> None:
+        if fl["done"]: return
+        fl["log"].append(item)
+        for q in fl["queues"]: q.put_nowait(item)
+        if item[0] in ("end", "error"):
+            fl["done"] = True
+            if self._flights.get(key) is fl: self._flights.pop(key, None)
+
+    def _finish(self, key: str, fl: Dict[str, Any], task: "asyncio.Task[Any]") -> None:
+        # pump упал чем-то неожиданным — ожидающие не должны висеть до таймаута
+        if not task.cancelled() and task.exception() is not None:
+            self._publish(key, fl, ("error", {"error": "Внешний API недоступен", "details": redact(str(task.exception())),
+                                              "source": "external_api"}))
+        if self._flights.get(key) is fl: self._flights.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
+
+
+class _FlightSink:
+    """Очередь для pump: put(item) раздаёт событие подписчикам рейса."""
+
+    def __init__(self, flights: _StreamFlights, key: str, fl: Dict[str, Any]):
+        self._flights, self._key, self._fl = flights, key, fl
+
+    async def put(self, item: Tuple[str, Any]) -> None:
+        self._flights._publish(self._key, self._fl, item)
+
+
+_UPSTREAM_FLIGHTS = _SingleFlight()
+_STREAM_FLIGHTS = _StreamFlights()
+
+
+def _req_key(req: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(req, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+async def _upstream_post(req: Dict[str, Any], kind: str = "chat") -> httpx.Response:
+    """POST во внешний API. Одинаковые тела, отправленные одновременно, уходят наружу один раз;
+    ответ уже прочитан целиком, поэтому один Response безопасно отдаётся всем ожидающим.
+    kind — чат или генерация: у них свои адаптивные таймауты чтения."""
+    client, sem = _upstream()
+
+    async def send() -> httpx.Response:
+        # слот семафора держим только на время попытки, не на паузу между повторами
+        async with sem:
+            started = time.monotonic()
+            r = await client.post(API_URL, headers=HEADERS, json=req, timeout=_request_timeout(UPSTREAM_TIMEOUTS.read(kind)))
+            if r.status_code//100 == 2: UPSTREAM_TIMEOUTS.observe(kind, time.monotonic() - started)
+            return r
+
+    async def call() -> httpx.Response:
+        r = await _send_resilient(send, kind)
+        METRICS.inc("upstream_received_bytes_total", r.num_bytes_downloaded or len(r.content))
+        return r
+    return await _UPSTREAM_FLIGHTS.do(_req_key(req), call)
+
+
+@asynccontextmanager
+async def _upstream_stream(req: Dict[str, Any], timeout: Any = httpx.USE_CLIENT_DEFAULT,
+                           kind: str = "chat") -> AsyncIterator[httpx.Response]:
+    """Потоковый вызов: слот семафора занят, пока вызывающий читает ответ.
+    Повторы — только до первого байта тела; оборвавшийся на середине поток не переигрываем.
+    Как и в _upstream_post, на паузу между повторами слот отпускаем."""
+    client, sem = _upstream()
+    request = client.build_request("POST", API_URL, headers=HEADERS, json=req, timeout=timeout)
+    held = False
+
+    async def send() -> httpx.Response:
+        nonlocal held
+        await sem.acquire(); held = True
+        try:
+            r = await client.send(request, stream=True)
+        except BaseException:
+            sem.release(); held = False
+            raise
+        if r.status_code in _RETRY_STATUSES:
+            # впереди пауза и повтор (или короткое тело ошибки у вызывающего) — слот не нужен
+            sem.release(); held = False
+        return r
+
+    try:
+        r = await _send_resilient(send, kind)
+        try:
+            yield r
+        finally:
+            await r.aclose()
+            METRICS.inc("upstream_received_bytes_total", r.num_bytes_downloaded)
+    finally:
+        if held: sem.release()
+
+
+async def _iter_upstream_deltas(r: httpx.Response) -> AsyncIterator[str]:
+    """Кусочки текста из SSE-ответа OpenAI-совместимого API. Если API не умеет stream
+    и вернул обычный JSON — отдаём весь ответ одним куском."""
+    if "text/event-stream" not in r.headers.get("content-type", ""):
+        data = json.loads(await r.aread())
+        yield data["choices"][0]["message"]["content"] or ""
+        return
+    async for line in r.aiter_lines():
+        if not line.startswith("data:"): continue
+        chunk = line[5:].strip()
+        if chunk == "[DONE]": break
+        if not chunk: continue
+        choice = (json.loads(chunk).get("choices") or [{}])[0]
+        text = (choice.get("delta") or {}).get("content") or (choice.get("message") or {}).get("content")
+        if text: yield text
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}  # nginx: не буферизовать поток
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# =========================
+#  Кэш сгенерированных игр (на диске)
+# =========================
+GAME_CACHE_DIR = os.getenv("GAME_CACHE_DIR", os.path.join(BASE_DIR, "cache", "games"))
+GAME_CACHE_MAX_BYTES = int(os.getenv("GAME_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+class GameCache:
+    """HTML игр, адресованный sha256 от итогового промпта (текст + все опции).
+    LRU по mtime файла: при попадании mtime обновляется, при переполнении удаляются самые старые."""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._sizes: Optional["OrderedDict[str, int]"] = None  # key -> size, от старых к свежим
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(req: Dict[str, Any]) -> str:
+        raw = json.dumps({"model": req.get("model"), "messages": req.get("messages")}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.html")
+
+    def _scan(self) -> "OrderedDict[str, int]":
+        # при первом обращении восстанавливаем порядок LRU по mtime файлов
+        if self._sizes is None:
+            found = []
+            if os.path.isdir(self.root):
+                for shard in os.scandir(self.root):
+                    if not shard.is_dir(): continue
+                    for f in os.scandir(shard.path):
+                        if f.name.endswith(".html"):
+                            st = f.stat()
+                            found.append((st.st_mtime, f.name[:-5], st.st_size))
+            found.sort()
+            self._sizes = OrderedDict((k, size) for _, k, size in found)
+            self._bytes = sum(self._sizes.values())
+        return self._sizes
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                html = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock: self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            sizes = self._scan()
+            if key in sizes: sizes.move_to_end(key)
+        return html
+
+    def put(self, key: str, html: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = html.encode("utf-8")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            sizes = self._scan()
+            self._bytes += len(data) - sizes.pop(key, 0)
+            sizes[key] = len(data)
+            while self._bytes > self.max_bytes and len(sizes) > 1:
+                old, size = sizes.popitem(last=False)
+                self._bytes -= size
+                try: os.remove(self._path(old))
+                except OSError: pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sizes = self._scan()
+            return {"hits": self.hits, "misses": self.misses, "entries": len(sizes), "bytes": self._bytes}
+
+
+GAME_CACHE = GameCache(GAME_CACHE_DIR, GAME_CACHE_MAX_BYTES)
+
+
 # =========================
 #  Генерация игры
 # =========================
+def _game_text(payload: Dict[str, Any]) -> str:
+    """Текст для игры: поле text или отрывок документа — чанк chunk (с 1) загрузки doc_id / сэмпла slug.
+    Может распаковывать холодный документ, поэтому из async-обработчиков — через asyncio.to_thread."""
+    text = (payload.get("text") or "").strip()
+    if text or not payload.get("chunk"):
+        return text
+    doc_dir = _doc_dir(str(payload.get("doc_id") or ""), str(payload.get("slug") or ""))
+    layout = _doc_layout_for(doc_dir) if doc_dir else None
+    try:
+        n = int(payload["chunk"])
+    except (TypeError, ValueError):
+        return ""
+    spans = (layout or {}).get("chunks") or []
+    if not 1 <= n <= len(spans):
+        return ""
+    return _read_ranges(doc_dir, [spans[n - 1]])[0].strip()
+
+
 @app.post("/generate")
 async def generate_game(payload: Dict[str, Any]):
-    trace_id = str(uuid.uuid4())[:8]
-    book_text = (payload.get("text") or "").strip()
+    trace_id = _new_trace_id()
+    book_text = await asyncio.to_thread(_game_text, payload)
     if not book_text:
         return JSONResponse({"error": "Текст пустой", "trace_id": trace_id}, status_code=400)
 
-    prompt = build_prompt(book_text, payload)
+    req = {"messages":[{"role":"user","content":build_prompt(book_text, payload)}],"model":"solver"}
+    cache_key = GAME_CACHE.key(req)
+    cached = None if payload.get("regenerate") else GAME_CACHE.get(cache_key)
+    if cached is not None:
+        return JSONResponse({"code": cached, "trace_id": trace_id, "cached": True})
     try:
-        async with httpx.AsyncClient(timeout=_request_timeout()) as client:
-            r = await client.post(API_URL, headers=HEADERS, json={"messages":[{"role":"user","content":prompt}],"model":"solver"})
-    except httpx.TimeoutException as e:
-        return JSONResponse({"error":"Внешний API не ответил вовремя","details":redact(str(e)),"trace_id":trace_id,"source":"external_api"}, status_code=504)
+        r = await _upstream_post(req, kind="generate")
     except httpx.HTTPError as e:
-        return JSONResponse({"error":"Ошибка запроса к внешнему API","details":redact(str(e)),"trace_id":trace_id,"source":"external_api"}, status_code=502)
+        msg, code = _upstream_error(e)
+        return JSONResponse({"error":msg,"details":redact(str(e)),"trace_id":trace_id,"source":"external_api"}, status_code=code)
 
     text = r.text
     if r.status_code//100 != 2:
         return JSONResponse({"error":"Внешний API вернул ошибку","status":r.status_code,"details":redact(text),"trace_id":trace_id,"source":"external_api"}, status_code=502)
 
     try:
-        data = r.json()
+        with METRICS.stage("parse_response", route="generate"):
+            data = r.json()
         game_code = data["choices"][0]["message"]["content"]
         if not game_code or "<html" not in game_code.lower():
             raise ValueError("Ответ не похож на HTML игры")
+        GAME_CACHE.put(cache_key, game_code)
         return JSONResponse({"code": game_code, "trace_id": trace_id})
     except Exception as e:
         return JSONResponse({"error":"Не удалось разобрать ответ внешнего API","details":redact(text) or redact(str(e)),"trace_id":trace_id,"source":"parsing"}, status_code=500)
 
 
+GENERATE_HEAD_CHECK = int(os.getenv("GENERATE_HEAD_CHECK", "2048"))       # сколько символов ждать до проверки <html
+GENERATE_IDLE_TIMEOUT = float(os.getenv("GENERATE_IDLE_TIMEOUT", "90"))    # тишина от внешнего API, после которой рвём
+GENERATE_STREAM_BUDGET = float(os.getenv("GENERATE_STREAM_BUDGET", "600")) # потолок на всю генерацию
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "10"))
+
+
+def _looks_like_html(head: str) -> bool:
+    low = head.lower()
+    return "<html" in low or "<!doctype html" in low
+
+
+async def _generation_pump(req: Dict[str, Any], queue: Any) -> None:
+    """Читает потоковый ответ внешнего API и кладёт в очередь ("delta", str), ("end", None)
+    или ("error", {...}). Общая часть /generate/stream (через _STREAM_FLIGHTS) и фоновых задач генерации."""
+    try:
+        async with _upstream_stream(req, timeout=_request_timeout(GENERATE_IDLE_TIMEOUT), kind="generate") as r:
+            if r.status_code//100 != 2:
+                body = (await r.aread()).decode("utf-8", errors="ignore")
+                await queue.put(("error", {"error":"Внешний API вернул ошибку","status":r.status_code,"details":redact(body),"source":"external_api"}))
+                return
+            async for delta in _iter_upstream_deltas(r):
+                await queue.put(("delta", delta))
+        await queue.put(("end", None))
+    except httpx.HTTPError as e:
+        await queue.put(("error", {"error":_upstream_error(e)[0],"details":redact(str(e)),"source":"external_api"}))
+    except (ValueError, KeyError, IndexError) as e:
+        await queue.put(("error", {"error":"Не удалось разобрать ответ внешнего API","details":redact(str(e)),"source":"parsing"}))
+
+
+@app.post("/generate/stream")
+async def generate_stream(payload: Dict[str, Any]):
+    """
+    Тело — как у /generate. Ответ — Server-Sent Events:
+      event: meta      {"trace_id": "..."}
+      event: progress  {"chars": N, "elapsed": сек}   # раз в SSE_HEARTBEAT, пока идёт генерация
+      event: delta     {"text": "..."}                # HTML по кусочкам (после проверки начала документа)
+      event: done      {"trace_id": "...", "chars": N}
+      event: error     {"error": "...", "details": "...", "trace_id": "..."}
+    """
+    trace_id = _new_trace_id()
+    book_text = await asyncio.to_thread(_game_text, payload)
+    if not book_text:
+        return JSONResponse({"error": "Текст пустой", "trace_id": trace_id}, status_code=400)
+    req = {"messages":[{"role":"user","content":build_prompt(book_text, payload)}],"model":"solver"}
+    cache_key = GAME_CACHE.key(req)
+    cached = None if payload.get("regenerate") else GAME_CACHE.get(cache_key)
+    if cached is not None:
+        async def hit():
+            yield _sse("meta", {"trace_id": trace_id, "cached": True})
+            yield _sse("delta", {"text": cached})
+            yield _sse("done", {"trace_id": trace_id, "chars": len(cached), "cached": True})
+        return StreamingResponse(hit(), media_type="text/event-stream", headers=SSE_HEADERS)
+    req["stream"] = True
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        started = last_data = loop.time()
+        # одинаковая генерация, уже идущая для другого клиента, не запускается второй раз
+        key = _req_key(req)
+        queue = _STREAM_FLIGHTS.subscribe(key, lambda sink: _generation_pump(req, sink))
+        head: List[str] = []   # начало документа копим, пока не убедимся, что это HTML
+        parts: List[str] = []  # весь документ — для кэша
+        chars, validated = 0, False
+        yield _sse("meta", {"trace_id": trace_id})
+        try:
+            while True:
+                now = loop.time()
+                if now - started > GENERATE_STREAM_BUDGET:
+                    yield _sse("error", {"error":"Генерация заняла слишком много времени","trace_id":trace_id,"source":"external_api"})
+                    return
+                if now - last_data > GENERATE_IDLE_TIMEOUT:
+                    yield _sse("error", {"error":"Внешний API перестал отвечать","trace_id":trace_id,"source":"external_api"})
+                    return
+                try:
+                    kind, item = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield _sse("progress", {"chars": chars, "elapsed": round(loop.time() - started, 1)})
+                    continue
+                if kind == "error":
+                    yield _sse("error", {**item, "trace_id": trace_id})
+                    return
+                if kind == "delta":
+                    last_data = loop.time()
+                    chars += len(item)
+                    parts.append(item)
+                    if validated:
+                        yield _sse("delta", {"text": item})
+                        continue
+                    head.append(item)
+                    if chars < GENERATE_HEAD_CHECK:
+                        continue
+                # набралось достаточно начала документа (или поток закончился) — проверяем
+                if not validated:
+                    text = "".join(head)
+                    if not _looks_like_html(text):
+                        yield _sse("error", {"error":"Ответ не похож на HTML игры","details":redact(text[:500]),"trace_id":trace_id,"source":"parsing"})
+                        return
+                    validated = True
+                    if text: yield _sse("delta", {"text": text})
+                    head = []
+                if kind == "end":
+                    GAME_CACHE.put(cache_key, "".join(parts))
+                    yield _sse("done", {"trace_id": trace_id, "chars": chars})
+                    return
+        finally:
+            _STREAM_FLIGHTS.unsubscribe(key, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 # =========================
-#  GPT-чат по книге
+#  Очередь генерации игр (фоновые задачи)
 # =========================
-_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё0-9]+")
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", "4"))            # одновременных генераций
+GEN_QUEUE_DEPTH = int(os.getenv("GEN_QUEUE_DEPTH", "64"))   # ожидающих задач; сверх — 429
+JOBS_ROOT = os.path.join(UPLOAD_ROOT, "_jobs")
+JOB_TAIL_CHARS = 600
+
+_JOBS: Dict[str, Dict[str, Any]] = {}   # активные задачи (queued/running); завершённые — только на диске
+_JOB_BY_KEY: Dict[str, str] = {}         # ключ кэша игры -> id активной задачи (одинаковые склеиваем)
+_GEN: Dict[str, Any] = {"queue": None, "workers": []}
+
+
+def _job_dir(job_id: str) -> str:
+    return os.path.join(JOBS_ROOT, job_id)
+
+
+def _job_public(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in job.items() if not k.startswith("_")}
+    if job.get("state") == "done":
+        out["result_url"] = f"/jobs/{job['job_id']}/result"
+    return out
+
+
+def _job_save(job: Dict[str, Any]) -> None:
+    _write_json_atomic(os.path.join(_job_dir(job["job_id"]), "job.json"), _job_public(job))
+
+
+def _job_finish(job: Dict[str, Any], html: Optional[str] = None, **fields) -> None:
+    if html is not None:
+        path = os.path.join(_job_dir(job["job_id"]), "game.html")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(html)
+        os.replace(path + ".tmp", path)
+    job.update(fields, finished=time.time())
+    job.pop("tail", None)
+    _job_save(job)
+    _JOBS.pop(job["job_id"], None)
+    if _JOB_BY_KEY.get(job["_key"]) == job["job_id"]:
+        _JOB_BY_KEY.pop(job["_key"], None)
+
+
+async def _run_job(job: Dict[str, Any]) -> None:
+    """Одна генерация: поток из внешнего API, прогресс в job["chars"], результат — в game.html."""
+    job.update(state="running", started=time.time())
+    _job_save(job)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GENERATE_STREAM_BUDGET
+    queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+    task = asyncio.create_task(_generation_pump(job["_req"], queue))
+    parts: List[str] = []
+    try:
+        while True:
+            try:
+                kind, item = await asyncio.wait_for(queue.get(), timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                _job_finish(job, state="error", error="Генерация заняла слишком много времени", source="external_api")
+                return
+            if kind == "error":
+                _job_finish(job, state="error", **item)
+                return
+            if kind == "delta":
+                parts.append(item)
+                job["chars"] += len(item)
+                job["tail"] = "".join(parts[-8:])[-JOB_TAIL_CHARS:]  # хвост кода для превью на клиенте
+                continue
+            html = "".join(parts)
+            if not _looks_like_html(html[:GENERATE_HEAD_CHECK]):
+                _job_finish(job, state="error", error="Ответ не похож на HTML игры", details=redact(html[:500]), source="parsing")
+                return
+            GAME_CACHE.put(job["_key"], html)
+            _job_finish(job, html, state="done")
+            return
+    finally:
+        task.cancel()
+
+
+async def _gen_worker() -> None:
+    queue = _GEN["queue"]
+    while True:
+        job = await queue.get()
+        try:
+            await _run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _job_finish(job, state="error", error="Внутренняя ошибка", details=redact(str(e)), source="backend")
+        finally:
+            queue.task_done()
+
+
+def _gen_start() -> None:
+    os.makedirs(JOBS_ROOT, exist_ok=True)
+    _GEN["queue"] = asyncio.Queue(maxsize=max(1, GEN_QUEUE_DEPTH))
+    _GEN["workers"] = [asyncio.create_task(_gen_worker()) for _ in range(max(1, GEN_WORKERS))]
+
+
+async def _gen_stop() -> None:
+    for w in _GEN["workers"]: w.cancel()
+    await asyncio.gather(*_GEN["workers"], return_exceptions=True)
+    _GEN.update(queue=None, workers=[])
+    # незавершённые задачи на диске помечаем, чтобы клиент не ждал вечно
+    for job in list(_JOBS.values()):
+        _job_finish(job, state="error", error="Сервер перезапущен, генерация прервана", source="backend")
+
+
+def _read_job(job_id: str) -> Optional[Dict[str, Any]]:
+    if not _SAFE_ID_RE.match(job_id): return None
+    job = _JOBS.get(job_id)
+    if job: return _job_public(job)
+    try:
+        with open(os.path.join(_job_dir(job_id), "job.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-def _tokenize(s: str) -> List[str]:
-    return [w.lower() for w in _WORD_RE.findall(s or "")]
 
-def _score(text: str, query_words: List[str]) -> int:
-    if not text: return 0
-    words = _tokenize(text)
-    # простая метрика: количество пересечений (уникальные термы)
-    ws = set(words)
-    return sum(1 for q in set(query_words) if q in ws)
+@app.post("/jobs/generate")
+async def submit_generate_job(payload: Dict[str, Any]):
+    """
+    Тело — как у /generate. Ответ сразу: {"job_id", "state", "status_url"}; 429 — если очередь полна.
+    Одинаковый запрос, пока прежний ещё в работе, получает тот же job_id.
+    """
+    trace_id = _new_trace_id()
+    book_text = await asyncio.to_thread(_game_text, payload)
+    if not book_text:
+        return JSONResponse({"error": "Текст пустой", "trace_id": trace_id}, status_code=400)
+    queue = _GEN["queue"]
+    if queue is None:
+        return JSONResponse({"error": "Очередь генерации не запущена", "trace_id": trace_id}, status_code=503)
+    req = {"messages":[{"role":"user","content":build_prompt(book_text, payload)}],"model":"solver", "stream": True}
+    cache_key = GAME_CACHE.key(req)
+    if cache_key in _JOB_BY_KEY:
+        job = _JOBS[_JOB_BY_KEY[cache_key]]
+        return JSONResponse({**_job_public(job), "status_url": f"/jobs/{job['job_id']}"}, status_code=202)
+
+    job_id = uuid.uuid4().hex[:12]
+    job = {"job_id": job_id, "state": "queued", "trace_id": trace_id, "created": time.time(), "chars": 0,
+           "_key": cache_key, "_req": req}
+    os.makedirs(_job_dir(job_id), exist_ok=True)
+    cached = None if payload.get("regenerate") else GAME_CACHE.get(cache_key)
+    if cached is not None:
+        job["_key"] = ""
+        _job_finish(job, cached, state="done", chars=len(cached), cached=True)
+        return JSONResponse({**_job_public(job), "status_url": f"/jobs/{job_id}"})
+    try:
+        queue.put_nowait(job)
+    except asyncio.QueueFull:
+        os.rmdir(_job_dir(job_id))
+        return JSONResponse({"error": "Очередь генерации переполнена, попробуйте позже", "trace_id": trace_id},
+                            status_code=429, headers={"Retry-After": "10"})
+    _JOBS[job_id] = job
+    _JOB_BY_KEY[cache_key] = job_id
+    _job_save(job)
+    return JSONResponse({**_job_public(job), "status_url": f"/jobs/{job_id}", "queue_position": queue.qsize()}, status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = _read_job(job_id)
+    if not job:
+        return JSONResponse({"error": "Задача не найдена"}, status_code=404)
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = _read_job(job_id)
+    if not job:
+        return JSONResponse({"error": "Задача не найдена"}, status_code=404)
+    if job.get("state") != "done":
+        return JSONResponse({"error": "Игра ещё не готова", "state": job.get("state")}, status_code=409)
+    with open(os.path.join(_job_dir(job_id), "game.html"), "r", encoding="utf-8") as f:
+        code = f.read()
+    return JSONResponse({"code": code, "trace_id": job.get("trace_id"), "cached": bool(job.get("cached"))})
+
 
-def _select_context(doc: Dict[str, Any], question: str, max_chars: int = 6000) -> Tuple[str, List[str]]:
-    """Вернём слитый контекст и список названий глав, которые попали в контекст."""
+# =========================
+#  GPT-чат по книге
+# =========================
+CHAT_RETRIEVAL = os.getenv("CHAT_RETRIEVAL", "pages")  # chapters | pages | passages | chunks
+RETRIEVAL_MODES = {"chapters", "pages", "passages", "chunks"}
+
+
+def _select_passages(doc: Dict[str, Any], question: str, max_chars: int, index: Dict[str, Any],
+                     unit_name: str) -> Tuple[str, List[str]]:
+    """Жадно набиваем бюджет символов лучшими страницами/пассажами; в used — номера страниц."""
+    pages = doc.get("pages") or []
+    unit = index["units"][unit_name]
+    spans = unit.get("spans") or [[p, 0, len(t)] for p, t in enumerate(pages)]
+    scores = _bm25(unit, _tokenize(question))
+    ranked = sorted(scores, key=lambda i: scores[i], reverse=True) or list(range(len(spans)))
+    picked: List[List[int]] = []
+    size = 0
+    for i in ranked:
+        p, a, b = spans[i]
+        # перекрывающиеся окна одной страницы не дублируем
+        if any(q == p and a < qb and qa < b for q, qa, qb in picked): continue
+        cost = len(f"### стр. {p + 1}\n") + (b - a) + 2
+        if size + cost > max_chars: continue
+        picked.append([p, a, b]); size += cost
+        if max_chars - size < 200: break
+    picked.sort()  # в порядке следования в книге
+    buf = [f"### стр. {p + 1}\n{pages[p][a:b].strip()}\n" for p, a, b in picked]
+    used = []
+    for p, _, _ in picked:
+        label = f"стр. {p + 1}"
+        if label not in used: used.append(label)
+    return "\n".join(buf)[:max_chars], used
+
+
+def _select_chunks(doc: Dict[str, Any], question: str, max_chars: int, index: Dict[str, Any]) -> Tuple[str, List[str]]:
+    """Лучшие чанки в пределах бюджета, в порядке следования в книге; в used — страницы, где они начинаются."""
+    chunks, owners = doc["chunks"], doc.get("chunk_pages") or [0] * len(doc["chunks"])
+    scores = _bm25(index["units"]["chunks"], _tokenize(question))
+    ranked = sorted(scores, key=lambda i: scores[i], reverse=True) or list(range(len(chunks)))
+    picked: List[int] = []
+    size = 0
+    for i in ranked:
+        cost = len(f"### стр. {owners[i] + 1}\n") + len(chunks[i]) + 2
+        if size + cost > max_chars: continue
+        picked.append(i); size += cost
+        if max_chars - size < 200: break
+    picked.sort()
+    buf = [f"### стр. {owners[i] + 1}\n{chunks[i].strip()}\n" for i in picked]
+    used = []
+    for i in picked:
+        label = f"стр. {owners[i] + 1}"
+        if label not in used: used.append(label)
+    return "\n".join(buf)[:max_chars], used
+
+
+def _select_context(doc: Dict[str, Any], question: str, max_chars: int = 6000,
+                    index: Optional[Dict[str, Any]] = None, mode: str = "chapters") -> Tuple[str, List[str]]:
+    """Вернём слитый контекст и список названий глав (или страниц), которые попали в контекст.
+    index — готовый инвертированный индекс документа; без него строим на лету только нужную единицу.
+    mode: chapters — топ-2 главы целиком; pages/passages — лучшие страницы или окна страниц;
+    chunks — лучшие чанки (у документа без чанков — как passages)."""
+    if mode == "chunks":
+        if doc.get("chunks"):
+            if index is None or "chunks" not in index["units"]:
+                index = _build_index(doc, units=("chunks",))
+            return _select_chunks(doc, question, max_chars, index)
+        mode = "passages"
+    if mode in ("pages", "passages") and doc.get("pages"):
+        if index is None or mode not in index["units"]:
+            index = _build_index(doc, units=(mode,))
+        return _select_passages(doc, question, max_chars, index, mode)
     chapters = doc.get("chapters") or []
-    qwords = _tokenize(question)
+    if index is None:
+        index = _build_index(doc, units=("chapters",))
+    scores = _bm25(index["units"]["chapters"], _tokenize(question))
     scored = []
-    for ch in chapters:
-        text = ch.get("text") or ""
-        scored.append(( _score(text, qwords), ch.get("title") or "Без названия", text ))
+    for i, ch in enumerate(chapters):
+        scored.append(( scores.get(i, 0.0), ch.get("title") or "Без названия", ch.get("text") or "" ))
     # отбираем топ-2 релевантных (или первые 2, если нули)
     scored.sort(key=lambda t: t[0], reverse=True)
     picked = scored[:2] if scored else []
@@ -643,24 +3199,107 @@ def _select_context(doc: Dict[str, Any], question: str, max_chars: int = 6000) -
         buf.append(f"### {chapters[0].get('title','Глава 1')}\n{chapters[0].get('text','')}\n")
     return "\n".join(buf)[:max_chars], used_titles
 
-@app.post("/chat")
-async def chat_qa(payload: Dict[str, Any]):
-    """
-    Принимаем:
-      {
-        "question": "...",
-        "history": [{"role":"user"|"assistant","content":"..."}],
-        "doc": {"title":"...", "chapters":[{"title":"...","text":"..."}], "pages":[...]}
-      }
-    """
-    trace_id = str(uuid.uuid4())[:8]
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "86400"))          # секунд жизни ответа; 0 — кэш выключен
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "5000"))
+
+
+class ChatCache:
+    """Ответы /chat в памяти: ключ — документ, нормализованный вопрос, выбранный контекст и история.
+    Записи живут CHAT_CACHE_TTL секунд, сверх max_entries вытесняются по LRU.
+    Для каждого документа помним подпись data.json: поменялась — все его ответы выбрасываем."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = self.invalidations = 0
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._sigs: Dict[str, Any] = {}  # doc_key -> подпись data.json
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(doc_key: str, question: str, context: str, history: List[Dict[str, str]], mode: str) -> str:
+        raw = json.dumps({
+            "doc": doc_key,
+            "q": " ".join(_tokenize(question)),
+            "ctx": hashlib.sha256(context.encode("utf-8")).hexdigest(),
+            "hist": history,
+            "mode": mode,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def check_doc(self, doc_key: str, sig: Any) -> None:
+        """Сверяем подпись документа; при изменении data.json сбрасываем все его ответы."""
+        with self._lock:
+            old = self._sigs.get(doc_key)
+            self._sigs[doc_key] = sig
+            if old is None or old == sig: return
+            stale = [k for k, v in self._items.items() if v["doc"] == doc_key]
+            for k in stale: del self._items[k]
+            self.invalidations += len(stale)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if self.ttl <= 0: return None
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item["expires"] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item
+            if item: del self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, doc_key: str, answer: str, used: List[str]) -> None:
+        if self.ttl <= 0 or not answer: return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = {"doc": doc_key, "answer": answer, "used": used, "expires": time.monotonic() + self.ttl}
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                    "entries": len(self._items), "invalidations": self.invalidations}
+
+
+CHAT_CACHE = ChatCache(CHAT_CACHE_TTL, CHAT_CACHE_MAX_ENTRIES)
+
+
+def _chat_prepare(payload: Dict[str, Any], trace_id: str):
+    """Общая часть /chat и /chat/stream: документ, контекст и тело запроса к внешнему API.
+    Синхронная и тяжёлая (чтение документа, при необходимости — сборка индекса), зовётся через to_thread.
+    Возвращает (req, used, doc_key, cache_key) или готовый JSONResponse с ошибкой."""
     question = (payload.get("question") or "").strip()
     history = payload.get("history") or []
-    doc = payload.get("doc") or {}
     if not question:
         return JSONResponse({"error":"Вопрос пустой","trace_id":trace_id}, status_code=400)
 
-    context, used = _select_context(doc, question, max_chars=6000)
+    doc_id = str(payload.get("doc_id") or "")
+    slug = str(payload.get("slug") or "")
+    if doc_id or slug:
+        path = _doc_path(doc_id, slug)
+        doc = DOC_STORE.get(path) if path else None
+        if doc is None:
+            st = _read_status(doc_id) if doc_id and path else None
+            if st and st.get("state") in ("queued", "running"):
+                return JSONResponse({"error":"Документ ещё обрабатывается","trace_id":trace_id}, status_code=409)
+            return JSONResponse({"error":"Документ не найден","trace_id":trace_id}, status_code=404)
+        index = DOC_STORE.index(path)
+        # ключ — папка документа: одинаковые загрузки под разными алиасами делят кэш ответов
+        doc_key = f"slug:{slug}" if slug and not doc_id else f"doc:{os.path.basename(os.path.dirname(path))}"
+        CHAT_CACHE.check_doc(doc_key, DOC_STORE.signature(path))
+    else:
+        doc = payload.get("doc") or {}
+        index = None
+        doc_key = "inline"  # документ пришёл в теле — его содержимое учтено через хэш контекста
+
+    mode = str(payload.get("retrieval") or CHAT_RETRIEVAL)
+    if mode not in RETRIEVAL_MODES: mode = "chapters"
+    with METRICS.stage("select_context", mode=mode):
+        context, used = _select_context(doc, question, max_chars=6000, index=index, mode=mode)
     sys_main = {
         "role": "system",
         "content": (
@@ -682,36 +3321,178 @@ async def chat_qa(payload: Dict[str, Any]):
 
     messages = [sys_main, sys_ctx] + safe_hist + [{"role":"user","content":question}]
     req = {"model":"solver", "messages": messages, "temperature": 0.2, "max_tokens": 700}
+    cache_key = CHAT_CACHE.key(doc_key, question, context, safe_hist, mode)
+    return req, used, doc_key, cache_key
+
+
+@app.post("/chat")
+async def chat_qa(payload: Dict[str, Any]):
+    """
+    Принимаем:
+      {
+        "question": "...",
+        "history": [{"role":"user"|"assistant","content":"..."}],
+        "doc_id": "..." | "slug": "...",   # документ берётся из хранилища на сервере
+        "doc": {"title":"...", "chapters":[{"title":"...","text":"..."}], "pages":[...]},  # устаревший вариант
+        "retrieval": "chapters" | "pages" | "passages" | "chunks"   # необязательно, по умолчанию CHAT_RETRIEVAL
+      }
+    """
+    trace_id = _new_trace_id()
+    prep = await asyncio.to_thread(_chat_prepare, payload, trace_id)  # загрузка документа и индекса — не в event loop
+    if isinstance(prep, JSONResponse):
+        return prep
+    req, used, doc_key, cache_key = prep
+    hit = CHAT_CACHE.get(cache_key)
+    if hit:
+        return JSONResponse({"answer": hit["answer"], "used": hit["used"], "trace_id": trace_id, "cached": True})
 
     try:
-        async with httpx.AsyncClient(timeout=_request_timeout()) as client:
-            r = await client.post(API_URL, headers=HEADERS, json=req)
-    except httpx.TimeoutException as e:
-        return JSONResponse({"error":"Внешний API не ответил вовремя","details":redact(str(e)),"trace_id":trace_id}, status_code=504)
+        r = await _upstream_post(req, kind="chat")
     except httpx.HTTPError as e:
-        return JSONResponse({"error":"Ошибка запроса к внешнему API","details":redact(str(e)),"trace_id":trace_id}, status_code=502)
+        msg, code = _upstream_error(e)
+        return JSONResponse({"error":msg,"details":redact(str(e)),"trace_id":trace_id}, status_code=code)
 
     text = r.text
     if r.status_code//100 != 2:
         return JSONResponse({"error":"Внешний API вернул ошибку","status":r.status_code,"details":redact(text),"trace_id":trace_id}, status_code=502)
 
     try:
-        data = r.json()
+        with METRICS.stage("parse_response", route="chat"):
+            data = r.json()
         answer = data["choices"][0]["message"]["content"]
+        CHAT_CACHE.put(cache_key, doc_key, answer, used)
         return JSONResponse({"answer": answer, "used": used, "trace_id": trace_id})
     except Exception as e:
         return JSONResponse({"error":"Не удалось разобрать ответ внешнего API","details":redact(text) or redact(str(e)),"trace_id":trace_id,"source":"parsing"}, status_code=500)
 
 
+async def _chat_pump(req: Dict[str, Any], queue: Any) -> None:
+    """Как _generation_pump, но для потока ответа /chat/stream."""
+    try:
+        async with _upstream_stream({**req, "stream": True}, timeout=_request_timeout(UPSTREAM_STREAM_IDLE)) as r:
+            if r.status_code//100 != 2:
+                body = (await r.aread()).decode("utf-8", errors="ignore")
+                await queue.put(("error", {"error":"Внешний API вернул ошибку","status":r.status_code,"details":redact(body)}))
+                return
+            async for delta in _iter_upstream_deltas(r):
+                await queue.put(("delta", delta))
+        await queue.put(("end", None))
+    except httpx.HTTPError as e:
+        await queue.put(("error", {"error":_upstream_error(e)[0],"details":redact(str(e))}))
+    except (ValueError, KeyError, IndexError) as e:
+        await queue.put(("error", {"error":"Не удалось разобрать ответ внешнего API","details":redact(str(e)),"source":"parsing"}))
+
+
+@app.post("/chat/stream")
+async def chat_stream(payload: Dict[str, Any]):
+    """
+    То же тело, что у /chat; ответ — Server-Sent Events:
+      event: meta   {"used": [...], "trace_id": "...", "cached": bool}
+      event: delta  {"text": "..."}            # кусочки ответа по мере генерации
+      event: done   {"trace_id": "..."}
+      event: error  {"error": "...", "details": "...", "trace_id": "..."}
+    """
+    trace_id = _new_trace_id()
+    prep = await asyncio.to_thread(_chat_prepare, payload, trace_id)  # загрузка документа и индекса — не в event loop
+    if isinstance(prep, JSONResponse):
+        return prep
+    req, used, doc_key, cache_key = prep
+    hit = CHAT_CACHE.get(cache_key)
+
+    async def events():
+        if hit:
+            # готовый ответ из кэша отдаём одним куском
+            yield _sse("meta", {"used": hit["used"], "trace_id": trace_id, "cached": True})
+            yield _sse("delta", {"text": hit["answer"]})
+            yield _sse("done", {"trace_id": trace_id})
+            return
+        yield _sse("meta", {"used": used, "trace_id": trace_id, "cached": False})
+        parts: List[str] = []
+        deadline = time.monotonic() + CHAT_STREAM_BUDGET
+        # весь зал задал один и тот же вопрос — наружу уходит один поток, куски получают все
+        key = _req_key(req)
+        queue = _STREAM_FLIGHTS.subscribe(key, lambda sink: _chat_pump(req, sink))
+        try:
+            while True:
+                kind, item = await queue.get()
+                if kind == "error":
+                    yield _sse("error", {**item, "trace_id": trace_id})
+                    return
+                if kind == "end":
+                    break
+                parts.append(item)
+                yield _sse("delta", {"text": item})
+                if time.monotonic() > deadline and not _timeouts_disabled():
+                    yield _sse("error", {"error":"Ответ занял слишком много времени","trace_id":trace_id})
+                    return
+        finally:
+            _STREAM_FLIGHTS.unsubscribe(key, queue)
+        CHAT_CACHE.put(cache_key, doc_key, "".join(parts), used)
+        yield _sse("done", {"trace_id": trace_id})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# =========================
+#  Статистика и метрики
+# =========================
+@app.get("/stats")
+def stats():
+    return {"chat_cache": CHAT_CACHE.stats(), "game_cache": GAME_CACHE.stats(), "doc_store": DOC_STORE.stats(),
+            "uploads": _upload_stats(), "upstream": _upstream_stats(), "upstream_singleflight": _UPSTREAM_FLIGHTS.stats(),
+            "upstream_stream_singleflight": _STREAM_FLIGHTS.stats(),
+            "generate_jobs": {"active": len(_JOBS), "queued": _GEN["queue"].qsize() if _GEN["queue"] else 0,
+                              "workers": len(_GEN["workers"])},
+            "startup": _BOOT}
+
+
+def _scrape_gauges() -> List[Tuple[str, Dict[str, Any], float]]:
+    """Значения, которые дешевле снять в момент опроса, чем считать на каждом запросе."""
+    out: List[Tuple[str, Dict[str, Any], float]] = []
+    for name, st in (("chat", CHAT_CACHE.stats()), ("game", GAME_CACHE.stats()), ("doc_store", DOC_STORE.stats()),
+                     ("uploads", _upload_stats())):
+        if "hits" in st:
+            out.append(("cache_hits_total", {"cache": name}, st["hits"]))
+            out.append(("cache_misses_total", {"cache": name}, st["misses"]))
+        out.append(("cache_entries", {"cache": name}, st["entries"]))
+        if "bytes" in st: out.append(("cache_bytes", {"cache": name}, st["bytes"]))
+    out.append(("upstream_circuit_open", {}, 1 if UPSTREAM_BREAKER.state == "open" else 0))
+    out.append(("upstream_retries_total", {}, _UPSTREAM_COUNTS["retries"]))
+    out.append(("generate_jobs", {"state": "active"}, len(_JOBS)))
+    out.append(("generate_jobs", {"state": "queued"}, _GEN["queue"].qsize() if _GEN["queue"] else 0))
+    if _BOOT["ready_s"] is not None:
+        out.append(("startup_seconds", {"phase": "import"}, _BOOT["import_s"] or 0))
+        out.append(("startup_seconds", {"phase": "ready"}, _BOOT["ready_s"]))
+    return out
+
+
+@app.get("/metrics")
+def metrics(request: Request):
+    """Prometheus text format; с Accept: application/openmetrics-text — OpenMetrics с exemplars (trace_id)."""
+    openmetrics = "application/openmetrics-text" in request.headers.get("accept", "")
+    body = METRICS.render(_scrape_gauges(), openmetrics=openmetrics)
+    ctype = ("application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics
+             else "text/plain; version=0.0.4; charset=utf-8")
+    return Response(body, media_type=ctype)
+
+
 # =========================
 #  Global error
 # =========================
 @app.exception_handler(Exception)
 async def on_unhandled(request: Request, exc: Exception):
-    trace_id = str(uuid.uuid4())[:8]
+    trace_id = _new_trace_id()
     return JSONResponse({"error":"Внутренняя ошибка","details":redact(str(exc)),"trace_id":trace_id,"source":"backend"}, status_code=500)
 
 
+_BOOT["import_s"] = round(time.perf_counter() - _BOOT_T0, 3)
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["build-samples"]:
+        # готовый набор для деплоя: python app.py build-samples, затем SAMPLES_PREBUILT=1
+        built = ensure_samples(force=True, with_index=True)
+        print(f"samples: {len(built)} собрано в {SAMPLES_ROOT}")
+        sys.exit(0)
     import uvicorn
     uvicorn.run("app:app", host=os.getenv("HOST","127.0.0.1"), port=int(os.getenv("PORT","5000")), reload=True)
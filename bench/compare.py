@@ -0,0 +1,60 @@
+"""Сравнение двух прогонов bench/load.py или bench/micro.py; код выхода 1 — есть регрессия.
+
+    python bench/compare.py bench/results/base.json bench/results/new.json --threshold 0.1
+
+load: p95 (меньше — лучше) и RPS (больше — лучше) по паре сценарий × конкурентность;
+micro: медиана времени вызова по имени бенчмарка.
+"""
+import argparse, json, sys
+from typing import Any, Dict, List, Tuple
+
+# метрика -> True, если рост — это ухудшение
+METRICS = {"load": {"p95_ms": True, "rps": False}, "micro": {"median_ms": True}}
+
+
+def _rows(report: Dict[str, Any]) -> Dict[Tuple, Dict[str, Any]]:
+    if report.get("kind") == "micro":
+        return {(r["name"],): r for r in report["results"]}
+    return {(r["scenario"], r["concurrency"]): r for r in report["results"]}
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    kind = new.get("kind", "load")
+    old_rows, out = _rows(base), []
+    for key, row in _rows(new).items():
+        prev = old_rows.get(key)
+        if not prev: continue
+        for metric, higher_is_worse in METRICS[kind].items():
+            a, b = prev.get(metric), row.get(metric)
+            if not a or b is None: continue
+            change = (b - a) / a
+            worse = change > threshold if higher_is_worse else change < -threshold
+            out.append({"key": "/".join(map(str, key)), "metric": metric, "base": a, "new": b,
+                        "change": round(change, 4), "regression": worse})
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("base")
+    ap.add_argument("new")
+    ap.add_argument("--threshold", type=float, default=0.10, help="допустимое ухудшение, доля (0.10 = 10%%)")
+    ap.add_argument("--json", action="store_true", help="вывести сравнение в JSON")
+    args = ap.parse_args()
+    with open(args.base, encoding="utf-8") as f: base = json.load(f)
+    with open(args.new, encoding="utf-8") as f: new = json.load(f)
+    if base.get("kind") != new.get("kind"):
+        sys.exit(f"разные виды отчётов: {base.get('kind')} и {new.get('kind')}")
+
+    rows = compare(base, new, args.threshold)
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=1))
+    else:
+        for r in rows:
+            mark = "РЕГРЕССИЯ" if r["regression"] else ""
+            print(f"{r['key']:<42} {r['metric']:<10} {r['base']:>12} -> {r['new']:<12} {r['change']:+.1%} {mark}")
+    sys.exit(1 if any(r["regression"] for r in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Синтетические книги для бенчмарков: TXT, FB2, EPUB и PDF одного содержания заданного объёма.
+
+    python bench/corpora.py --mb 5 --chapters 40 --out bench/corpora
+
+Текст детерминирован (--seed), так что прогоны разных версий сравнимы. PDF нужен PyMuPDF.
+"""
+import argparse, os, random, textwrap, zipfile
+from typing import List, Tuple
+from xml.sax.saxutils import escape
+
+SYLLABLES = ("ра", "но", "ли", "ка", "то", "ве", "ми", "ст", "пра", "об", "ус", "ен", "ко", "да", "зна", "ти", "ре", "мо")
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_book(chars: int, chapters: int, seed: int = 1) -> List[Tuple[str, List[str]]]:
+    """[(название главы, [абзацы])] суммарно примерно на chars символов."""
+    rnd = random.Random(seed)
+    words = ["".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))) for _ in range(3000)]
+    per_chapter = max(1, chars // max(1, chapters))
+    book = []
+    for n in range(1, chapters + 1):
+        paras, size = [], 0
+        while size < per_chapter:
+            sentences = []
+            for _ in range(rnd.randint(2, 7)):
+                s = " ".join(rnd.choice(words) for _ in range(rnd.randint(5, 18)))
+                sentences.append(s[0].upper() + s[1:] + rnd.choice(".!?."))
+            para = " ".join(sentences)
+            paras.append(para); size += len(para) + 2
+        book.append((f"Глава {n}. {rnd.choice(words).capitalize()}", paras))
+    return book
+
+
+def write_txt(book, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        for title, paras in book:
+            f.write(title + "\n\n" + "\n\n".join(paras) + "\n\n")
+
+
+def write_fb2(book, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0">'
+                "<description><title-info><book-title>Синтетическая книга</book-title></title-info></description><body>")
+        for title, paras in book:
+            f.write(f"<section><title><p>{escape(title)}</p></title>")
+            f.writelines(f"<p>{escape(p)}</p>" for p in paras)
+            f.write("</section>")
+        f.write("</body></FictionBook>\n")
+
+
+def write_epub(book, path: str) -> None:
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml",
+                   '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        items, refs = [], []
+        for n, (title, paras) in enumerate(book, 1):
+            body = "".join(f"<p>{escape(p)}</p>" for p in paras)
+            z.writestr(f"OEBPS/ch{n}.xhtml", f'<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                                           f"<head><title>{escape(title)}</title></head><body><h1>{escape(title)}</h1>{body}</body></html>",
+                       compress_type=zipfile.ZIP_DEFLATED)
+            items.append(f'<item id="ch{n}" href="ch{n}.xhtml" media-type="application/xhtml+xml"/>')
+            refs.append(f'<itemref idref="ch{n}"/>')
+        z.writestr("OEBPS/content.opf",
+                   '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Синтетическая книга</dc:title></metadata>'
+                   f'<manifest>{"".join(items)}</manifest><spine>{"".join(refs)}</spine></package>')
+
+
+def write_pdf(book, path: str) -> bool:
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        return False
+    font = fitz.Font("cjk")  # встроенный шрифт с кириллицей; helv её не содержит
+    doc = fitz.open()
+    lines_per_page, leading = 64, 11.5
+    for title, paras in book:
+        # переносим строки сами: fill_textbox на длинном тексте работает в разы медленнее
+        lines = [title, ""] + [ln for p in paras for ln in textwrap.wrap(p, 95) + [""]]
+        for i in range(0, len(lines), lines_per_page):
+            page = doc.new_page()
+            writer = fitz.TextWriter(page.rect)
+            for j, line in enumerate(lines[i:i + lines_per_page]):
+                if line: writer.append((50, 50 + j * leading), line, font=font, fontsize=9)
+            writer.write_text(page)
+    doc.save(path, garbage=3, deflate=True)
+    return True
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--mb", type=float, default=5, help="объём текста, MB символов")
+    ap.add_argument("--chapters", type=int, default=40)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--formats", default="txt,fb2,epub,pdf")
+    ap.add_argument("--out", default=os.path.join(HERE, "corpora"))
+    args = ap.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    book = make_book(int(args.mb * 1024 * 1024), args.chapters, args.seed)
+    writers = {"txt": write_txt, "fb2": write_fb2, "epub": write_epub, "pdf": write_pdf}
+    for fmt in args.formats.split(","):
+        path = os.path.join(args.out, f"book.{fmt}")
+        if writers[fmt](book, path) is False:
+            print(f"{fmt}: пропущен (нет PyMuPDF)")
+            continue
+        print(f"{fmt}: {path} ({os.path.getsize(path) / 1024 / 1024:.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Нагрузочный прогон: сценарии × уровни конкурентности -> p50/p95/p99, RPS, ошибки и память сервера в JSON.
+
+    python bench/corpora.py --mb 2
+    python bench/load.py --scenarios samples,files,chat,generate,upload --concurrency 1,8,32 --requests 200
+
+По умолчанию поднимает bench/mock_upstream.py и app.py (uvicorn) на свободных портах с временным
+UPLOAD_ROOT — внешний API не трогается. --base-url меряет уже запущенный сервер (без памяти).
+Сравнение двух прогонов: python bench/compare.py base.json new.json
+"""
+import argparse, asyncio, json, os, platform, random, socket, statistics, subprocess, sys, tempfile, time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SCENARIOS = ("samples", "files", "chat", "chat_stream", "generate", "upload")
+UPLOAD_TYPES = {"txt": "text/plain", "fb2": "application/xml", "epub": "application/epub+zip", "pdf": "application/pdf"}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: Optional[int]) -> Dict[str, Optional[float]]:
+    """Текущая и пиковая память процесса из /proc (Linux); на других ОС — None."""
+    out: Dict[str, Optional[float]] = {"rss_mb": None, "rss_peak_mb": None}
+    if not pid: return out
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                key = {"VmRSS:": "rss_mb", "VmHWM:": "rss_peak_mb"}.get(line.split(":")[0] + ":")
+                if key: out[key] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return out
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def _unique(data: bytes, fmt: str, nonce: str) -> bytes:
+    """Делает файл уникальным, не ломая формат: иначе дедупликация загрузок отдаст готовый документ."""
+    if fmt == "fb2": return data + f"<!-- {nonce} -->".encode()
+    if fmt == "pdf": return data + f"\n%{nonce}\n".encode()
+    return data + f"\n{nonce}".encode()  # txt; у zip (epub) хвост после каталога игнорируется
+
+
+class Server:
+    """mock_upstream + app.py в отдельных процессах; останавливаются при выходе."""
+
+    def __init__(self, args):
+        self.args, self.procs, self.tmp = args, [], tempfile.TemporaryDirectory(prefix="bench-")
+        self.base_url, self.app_pid = "", None
+
+    def __enter__(self):
+        mock_port, app_port = _free_port(), _free_port()
+        self._spawn([sys.executable, os.path.join(HERE, "mock_upstream.py"), "--port", str(mock_port),
+                     "--latency", str(self.args.mock_latency), "--jitter", str(self.args.mock_jitter),
+                     "--stream-delay", str(self.args.mock_stream_delay)], os.environ)
+        env = {**os.environ, "API_URL": f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+               "UPLOAD_ROOT": os.path.join(self.tmp.name, "uploads"),
+               "GAME_CACHE_DIR": os.path.join(self.tmp.name, "games"),
+               "SAMPLES_PREBUILT": "1", "MAINTENANCE_INTERVAL": "0"}
+        app = self._spawn([sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(app_port),
+                           "--log-level", "warning"], env)
+        self.app_pid = app.pid
+        self.base_url = f"http://127.0.0.1:{app_port}"
+        self._wait(f"http://127.0.0.1:{mock_port}/stats")
+        self._wait(f"{self.base_url}/samples")
+        return self
+
+    def _spawn(self, cmd: List[str], env) -> subprocess.Popen:
+        p = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.procs.append(p)
+        return p
+
+    @staticmethod
+    def _wait(url: str, timeout: float = 30) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if httpx.get(url, timeout=1).status_code < 500: return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"сервер не поднялся: {url}")
+
+    def __exit__(self, *exc):
+        for p in self.procs: p.terminate()
+        for p in self.procs:
+            try: p.wait(timeout=10)
+            except subprocess.TimeoutExpired: p.kill()
+        self.tmp.cleanup()
+
+
+async def _upload(client: httpx.AsyncClient, path: str, nonce: str, timeout: float = 600) -> Dict[str, Any]:
+    """POST /upload и ожидание разбора; возвращает финальный статус."""
+    fmt = path.rsplit(".", 1)[1]
+    with open(path, "rb") as f:
+        data = _unique(f.read(), fmt, nonce)
+    r = await client.post("/upload", files={"file": (os.path.basename(path), data, UPLOAD_TYPES[fmt])})
+    r.raise_for_status()
+    doc_id, deadline = r.json()["doc_id"], time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        st = (await client.get(f"/upload/{doc_id}/status")).json()
+        if st.get("state") in ("done", "error"):
+            if st["state"] == "error": raise RuntimeError(st.get("details") or st.get("error"))
+            return st
+        await asyncio.sleep(0.05)
+    raise TimeoutError("документ не разобран")
+
+
+async def _prepare(client: httpx.AsyncClient, args) -> Dict[str, Any]:
+    """Общий документ для files/chat: загружаем книгу из корпуса один раз."""
+    st = await _upload(client, args.doc, "bench-base")
+    pages = (await client.get(f"/files/{st['doc_id']}/pages", params={"from": 1, "to": 1})).json()["total"]
+    words = [w for w in open(args.doc, encoding="utf-8", errors="ignore").read(20000).split() if len(w) > 4] or ["текст"]
+    return {"doc_id": st["doc_id"], "pages": pages, "words": words}
+
+
+def _make_request(scenario: str, ctx: Dict[str, Any], args) -> Callable[[httpx.AsyncClient, int], Awaitable[int]]:
+    words = ctx["words"]
+
+    def question(i: int) -> str:
+        # каждый вопрос уникален — меряем путь до внешнего API, а не кэш ответов
+        return " ".join(random.sample(words, 3)) + ("?" if args.warm_cache else f" ({i})?")
+
+    async def samples(c, i):
+        return (await c.get("/samples")).status_code
+
+    async def files(c, i):
+        k = random.randint(1, max(1, ctx["pages"] - 2))
+        return (await c.get(f"/files/{ctx['doc_id']}/pages", params={"from": k, "to": k + 2})).status_code
+
+    async def chat(c, i):
+        return (await c.post("/chat", json={"doc_id": ctx["doc_id"], "question": question(i)})).status_code
+
+    async def chat_stream(c, i):
+        async with c.stream("POST", "/chat/stream", json={"doc_id": ctx["doc_id"], "question": question(i)}) as r:
+            async for _ in r.aiter_bytes(): pass
+            return r.status_code
+
+    async def generate(c, i):
+        text = " ".join(random.sample(words, min(len(words), 200))) + f" {i}"
+        return (await c.post("/generate", json={"text": text, "game_type": "quiz", "regenerate": True})).status_code
+
+    async def upload(c, i):
+        await _upload(c, args.upload_file, f"bench-{time.time_ns()}-{i}")
+        return 200
+
+    return {"samples": samples, "files": files, "chat": chat, "chat_stream": chat_stream,
+            "generate": generate, "upload": upload}[scenario]
+
+
+async def _run_level(client: httpx.AsyncClient, request, concurrency: int, total: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            t0 = time.perf_counter()
+            try:
+                status = await request(client, i)
+                key = None if status < 400 else str(status)
+            except Exception as e:  # сбой запроса — тоже результат прогона
+                key = type(e).__name__
+            latencies.append(time.perf_counter() - t0)
+            if key: errors[key] = errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies), "errors": sum(errors.values()), "error_kinds": errors,
+        "duration_s": round(elapsed, 3), "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2), "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+async def _bench(args, base_url: str, app_pid: Optional[int]) -> List[Dict[str, Any]]:
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 8, max_keepalive_connections=max(args.concurrency) + 8)
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        ctx = await _prepare(client, args)
+        for scenario in args.scenarios:
+            request = _make_request(scenario, ctx, args)
+            if args.warmup:
+                await _run_level(client, request, min(4, args.warmup), args.warmup)
+            for c in args.concurrency:
+                total = args.upload_requests if scenario == "upload" else args.requests
+                row = {"scenario": scenario, "concurrency": c, **await _run_level(client, request, c, max(c, total)),
+                       **_rss_mb(app_pid)}
+                results.append(row)
+                print(f"{scenario:<12} c={c:<4} rps={row['rps']:<9} p50={row['p50_ms']:<9} p95={row['p95_ms']:<9} "
+                      f"p99={row['p99_ms']:<9} err={row['errors']:<4} rss={row['rss_mb']}", flush=True)
+    return results
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenarios", default="samples,files,chat,generate,upload", help=f"через запятую из: {', '.join(SCENARIOS)}")
+    ap.add_argument("--concurrency", default="1,8,32", help="уровни конкурентности через запятую")
+    ap.add_argument("--requests", type=int, default=200, help="запросов на уровень")
+    ap.add_argument("--upload-requests", type=int, default=20, help="загрузок на уровень (они тяжелее)")
+    ap.add_argument("--warmup", type=int, default=10)
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--warm-cache", action="store_true", help="повторять вопросы чата (мерить кэш ответов)")
+    ap.add_argument("--doc", default=os.path.join(HERE, "corpora", "book.txt"), help="книга для files/chat")
+    ap.add_argument("--upload-file", default=os.path.join(HERE, "corpora", "book.txt"), help="файл для сценария upload")
+    ap.add_argument("--base-url", default="", help="мерить уже запущенный сервер")
+    ap.add_argument("--mock-latency", type=float, default=0.2)
+    ap.add_argument("--mock-jitter", type=float, default=0.05)
+    ap.add_argument("--mock-stream-delay", type=float, default=0.005)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="")
+    args = ap.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown: ap.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    for path in {args.doc, args.upload_file}:
+        if not os.path.isfile(path): ap.error(f"нет файла {path} — сначала python bench/corpora.py")
+    random.seed(args.seed)
+
+    started = time.time()
+    if args.base_url:
+        results = asyncio.run(_bench(args, args.base_url.rstrip("/"), None))
+    else:
+        with Server(args) as srv:
+            results = asyncio.run(_bench(args, srv.base_url, srv.app_pid))
+
+    report = {
+        "kind": "load",
+        "meta": {"started_at": int(started), "git": _git_rev(), "python": platform.python_version(),
+                 "platform": platform.platform(), "args": {k: v for k, v in vars(args).items()}},
+        "results": results,
+    }
+    out = args.out or os.path.join(HERE, "results", f"load-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"результат: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Микробенчмарки горячих функций app.py: пагинация, PDF -> фрагменты, индекс и выбор контекста.
+
+    python bench/micro.py --mb 2 --out bench/results/micro.json
+
+Каждая функция вызывается в цикле, пока один замер не займёт ≥ --min-time; замеров --repeat.
+В отчёте — время одного вызова (min/median/mean) и пик памяти одного вызова (tracemalloc).
+"""
+import argparse, json, os, platform, statistics, subprocess, sys, tempfile, time, tracemalloc
+from typing import Any, Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import corpora  # noqa: E402
+
+
+def measure(fn: Callable[[], Any], repeat: int, min_time: float) -> Dict[str, Any]:
+    number, elapsed = 1, 0.0
+    while True:  # как timeit.autorange: подбираем число вызовов на замер
+        t0 = time.perf_counter()
+        for _ in range(number): fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time: break
+        number *= 2 if elapsed * 10 > min_time else 10
+    runs = [elapsed / number]
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number): fn()
+        runs.append((time.perf_counter() - t0) / number)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"number": number, "min_ms": round(min(runs) * 1000, 4), "median_ms": round(statistics.median(runs) * 1000, 4),
+            "mean_ms": round(statistics.fmean(runs) * 1000, 4), "peak_kb": round(peak / 1024, 1)}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--mb", type=float, default=2, help="объём синтетического текста, MB символов")
+    ap.add_argument("--pdf", default=os.path.join(HERE, "corpora", "book.pdf"), help="PDF для _pdf_to_text_chunks")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2)
+    ap.add_argument("--only", default="", help="подстрока имени бенчмарка")
+    ap.add_argument("--out", default="")
+    args = ap.parse_args()
+
+    os.environ.setdefault("PDF_WORKERS", "1")  # без пула процессов: меряем сам разбор
+    tmp = tempfile.TemporaryDirectory(prefix="bench-micro-")
+    os.environ.setdefault("UPLOAD_ROOT", os.path.join(tmp.name, "uploads"))
+    import app as A
+
+    book = corpora.make_book(int(args.mb * 1024 * 1024), 40)
+    chapters = [{"title": t, "text": "\n\n".join(p), "sections": []} for t, p in book]
+    text = A._normalize_text("\n\n".join(ch["text"] for ch in chapters))
+    A._write_doc(tmp.name, {"title": "bench"}, chapters)
+    doc = A._load_doc(tmp.name)
+    index = A._build_index(doc)
+    question = " ".join(text.split()[1000:1004])
+
+    pdf = args.pdf
+    if not os.path.isfile(pdf):
+        pdf = os.path.join(tmp.name, "book.pdf")
+        if not corpora.write_pdf(corpora.make_book(256 * 1024, 8), pdf): pdf = ""
+
+    benches: Dict[str, Callable[[], Any]] = {
+        f"page_spans[{args.mb}MB]": lambda: A._page_spans(text),
+        f"build_index[{args.mb}MB]": lambda: A._build_index(doc),
+    }
+    for mode in sorted(A.RETRIEVAL_MODES):
+        benches[f"select_context[{mode}]"] = lambda mode=mode: A._select_context(doc, question, 6000, index=index, mode=mode)
+        benches[f"select_context[{mode},no_index]"] = lambda mode=mode: A._select_context(doc, question, 6000, mode=mode)
+    if pdf and A._fitz():
+        benches[f"pdf_to_text_chunks[{os.path.basename(pdf)}]"] = lambda: A._pdf_to_text_chunks(pdf)
+
+    results: List[Dict[str, Any]] = []
+    for name, fn in benches.items():
+        if args.only and args.only not in name: continue
+        row = {"name": name, **measure(fn, args.repeat, args.min_time)}
+        results.append(row)
+        print(f"{name:<40} median={row['median_ms']:<12} min={row['min_ms']:<12} peak_kb={row['peak_kb']}", flush=True)
+
+    rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    report = {"kind": "micro", "meta": {"started_at": int(time.time()), "git": rev, "python": platform.python_version(),
+                                        "platform": platform.platform(), "args": vars(args)}, "results": results}
+    out = args.out or os.path.join(HERE, "results", f"micro-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    tmp.cleanup()
+    print(f"результат: {out}")
+
+
+if __name__ == "__main__":
+    main()
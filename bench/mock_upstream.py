@@ -0,0 +1,87 @@
+"""Локальная замена approxination.com для бенчмарков: OpenAI-совместимый /v1/chat/completions
+с настраиваемой задержкой, потоковой выдачей и долей ошибок.
+
+    python bench/mock_upstream.py --port 8901 --latency 0.5 --jitter 0.2 --stream-delay 0.01
+    API_URL=http://127.0.0.1:8901/v1/chat/completions python app.py
+
+GET /stats — сколько запросов пришло (обычных, потоковых, с ошибкой): удобно проверять кэши и склейку.
+"""
+import argparse, asyncio, json, random, time
+from typing import Any, AsyncIterator, Dict
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CFG: Dict[str, Any] = {"latency": 0.2, "jitter": 0.0, "stream_delay": 0.01, "chunk_chars": 40,
+                       "answer_chars": 600, "html_bytes": 12000, "error_rate": 0.0}
+COUNTS = {"requests": 0, "streams": 0, "errors": 0}
+
+app = FastAPI(title="mock upstream")
+
+
+def _answer(messages: Any) -> str:
+    """Игра (если промпт просит HTML) или ответ чата заданного размера."""
+    prompt = json.dumps(messages, ensure_ascii=False).lower()
+    if "html" in prompt:
+        body = "<p>" + "Уровень пройден. " * (CFG["html_bytes"] // 34) + "</p>"
+        return f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>game</title></head><body>{body}</body></html>"
+    return ("Ответ по контексту книги. " * (CFG["answer_chars"] // 26 + 1))[:CFG["answer_chars"]]
+
+
+def _delay() -> float:
+    return max(0.0, CFG["latency"] + random.uniform(-CFG["jitter"], CFG["jitter"]))
+
+
+def _completion(content: str) -> Dict[str, Any]:
+    return {"id": f"mock-{time.time_ns()}", "object": "chat.completion", "model": "mock",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}
+
+
+async def _stream(content: str) -> AsyncIterator[bytes]:
+    step = max(1, CFG["chunk_chars"])
+    for i in range(0, len(content), step):
+        delta = {"choices": [{"index": 0, "delta": {"content": content[i:i + step]}}]}
+        yield f"data: {json.dumps(delta, ensure_ascii=False)}\n\n".encode()
+        if CFG["stream_delay"]: await asyncio.sleep(CFG["stream_delay"])
+    yield b"data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def completions(payload: Dict[str, Any]):
+    COUNTS["requests"] += 1
+    await asyncio.sleep(_delay())  # время до первого байта
+    if random.random() < CFG["error_rate"]:
+        COUNTS["errors"] += 1
+        return JSONResponse({"error": "mock overloaded"}, status_code=503, headers={"Retry-After": "1"})
+    content = _answer(payload.get("messages"))
+    if payload.get("stream"):
+        COUNTS["streams"] += 1
+        return StreamingResponse(_stream(content), media_type="text/event-stream")
+    return _completion(content)
+
+
+@app.get("/stats")
+def stats():
+    return {**COUNTS, "config": CFG}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8901)
+    ap.add_argument("--latency", type=float, default=CFG["latency"], help="задержка до ответа, сек")
+    ap.add_argument("--jitter", type=float, default=CFG["jitter"], help="± к задержке, сек")
+    ap.add_argument("--stream-delay", type=float, default=CFG["stream_delay"], help="пауза между SSE-кусками, сек")
+    ap.add_argument("--chunk-chars", type=int, default=CFG["chunk_chars"], help="символов в одном SSE-куске")
+    ap.add_argument("--answer-chars", type=int, default=CFG["answer_chars"], help="длина ответа чата")
+    ap.add_argument("--html-bytes", type=int, default=CFG["html_bytes"], help="примерный размер игры")
+    ap.add_argument("--error-rate", type=float, default=CFG["error_rate"], help="доля ответов 503")
+    args = ap.parse_args()
+    CFG.update({k: v for k, v in vars(args).items() if k in CFG})
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,67 @@
+import hashlib
+import threading
+from io import BytesIO
+
 import streamlit as st
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# PyPDF2 и LangChain импортируются при первом использовании: без загруженного файла
+# страница открывается сразу, не дожидаясь тяжёлых зависимостей.
+
+CHUNK_SIZE = 1200  # размер чанка
+CHUNK_OVERLAP = 200  # перекрытие
+PAGES_PER_STEP = 20  # страниц за один шаг ленивого извлечения
+PREFETCH_CHUNKS = 3  # сколько чанков вперёд готовить, пока читается текущий
+
+
+def _splitter_cls():
+    try:
+        from langchain_text_splitters import RecursiveCharacterTextSplitter  # отдельный лёгкий пакет
+    except ImportError:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter
+
+
+@st.cache_resource
+def _splitter():
+    return _splitter_cls()(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len)
 
 
-# --- функция для чтения PDF ---
-def read_pdf(file):
-    pdf = PdfReader(file)
-    text = ""
-    for page in pdf.pages:
-        text += page.extract_text() + "\n"
-    return text
+# --- PDF: состояние на файл, страницы и чанки добираются по мере листания ---
+@st.cache_resource(max_entries=4, show_spinner=False)
+def open_pdf(file_hash, _data):
+    """Streamlit перезапускает скрипт на каждый клик, а это состояние живёт между перезапусками
+    (ключ — sha256 файла, сами байты не хэшируются): PdfReader открывается один раз,
+    уже извлечённые страницы и готовые чанки не пересчитываются."""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(BytesIO(_data))
+    return {"reader": reader, "pages": len(reader.pages), "next_page": 0, "chunks": [], "carry": "",
+            "lock": threading.Lock()}
+
+
+def extract_until(book, n_chunks):
+    """Извлекает страницы по PAGES_PER_STEP, пока не готово n_chunks чанков или не кончится книга.
+    Текст шага собирается через join; последний чанк шага может продолжиться на следующих
+    страницах, поэтому он не фиксируется, а режется заново вместе со следующим шагом."""
+    with book["lock"]:
+        while len(book["chunks"]) < n_chunks and book["next_page"] < book["pages"]:
+            a = book["next_page"]
+            b = min(book["pages"], a + PAGES_PER_STEP)
+            carry = book["carry"] + "\n" if book["carry"] else ""  # чанки приходят без хвостового перевода строки
+            parts = [carry] + [(book["reader"].pages[i].extract_text() or "") + "\n" for i in range(a, b)]
+            pieces = _splitter().split_text("".join(parts))
+            book["next_page"] = b
+            book["carry"] = pieces.pop() if pieces and b < book["pages"] else ""
+            book["chunks"].extend(pieces)
+        return book["chunks"]
+
+
+def file_hash(uploaded_file, data):
+    """sha256 файла; в рамках сессии считается один раз на загруженный файл."""
+    key = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    hashes = st.session_state.setdefault("file_hashes", {})
+    if key not in hashes:
+        hashes[key] = hashlib.sha256(data).hexdigest()
+    return hashes[key]
 
 
 # --- Streamlit UI ---
@@ -20,20 +72,22 @@ uploaded_file = st.file_uploader("Загрузите PDF книгу", type=["pdf
 if uploaded_file:
     st.success("Файл загружен!")
 
-    # Извлекаем текст
-    text = read_pdf(uploaded_file)
-    st.write(f"Общий объем текста: {len(text)} символов")
-
-    # Разбиваем на чанки через LangChain
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1200,  # размер чанка
-        chunk_overlap=200,  # перекрытие
-        length_function=len
-    )
-    chunks = splitter.split_text(text)
+    data = uploaded_file.getvalue()
+    book = open_pdf(file_hash(uploaded_file, data), data)
+    chunks = extract_until(book, 1)
+    if not chunks:
+        st.warning("В PDF не найден текст")
+        st.stop()
 
-    st.write(f"Количество чанков: {len(chunks)}")
+    # Навигация по чанкам: число чанков известно только после разбора всей книги, поэтому без
+    # верхней границы у поля — номер за концом просто показывает последний чанк
+    selected_chunk = st.number_input("Выберите номер чанка", 1, None, 1)
+    chunks = extract_until(book, selected_chunk + 1)
+    selected_chunk = min(selected_chunk, len(chunks))
 
-    # Навигация по чанкам
-    selected_chunk = st.number_input("Выберите номер чанка", 1, len(chunks), 1)
+    more = "" if book["next_page"] >= book["pages"] else "+"
+    st.write(f"Страниц: {book['next_page']} из {book['pages']} разобрано, чанков: {len(chunks)}{more}")
     st.text_area("Текст чанка", chunks[selected_chunk - 1], height=300)
+
+    # соседние чанки — заранее, пока читается текущий (страница уже отрисована)
+    extract_until(book, selected_chunk + PREFETCH_CHUNKS)